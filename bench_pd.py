@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+import torch
+import get_pd_vgg as pd_driver
+from knndnn import get_model, export_for_inference, make_tap_reducers, fit_tap_reducers, FeatureBank, \
+    knn_predict, knn_predict_self, prediction_depths, TapRegistry
+from pd_io import compare_pds
+from instrument import reset_peak_memory, peak_memory
+
+parser = argparse.ArgumentParser(description='offline benchmarks of the prediction depth hot paths, randomly '
+                                             'initialized models and synthetic images')
+parser.add_argument('--archs', default='vgg,mlp,resnet,resnet_ws', type=str, help='comma separated architectures')
+parser.add_argument('--batch_size', default=200, type=int, help='images per forward pass')
+parser.add_argument('--iters', default=5, type=int, help='timed forward passes per setting')
+parser.add_argument('--warmup', default=1, type=int, help='untimed forward passes per setting')
+parser.add_argument('--num_threads', default=0, type=int, help='torch threads (0: torch default)')
+parser.add_argument('--benches', default='layers,extract,knn,pd_layer,precision', type=str,
+                    help='comma separated benchmarks: layers / extract / knn / pd_layer / precision / reduce')
+parser.add_argument('--knn_ks', default='10,30,100', type=str, help='knn_k values of the knn bench')
+parser.add_argument('--batch_sizes', default='100,500', type=str, help='query / bank batch sizes of the knn, extract and pd_layer benches')
+parser.add_argument('--support_sizes', default='1000,4000', type=str, help='support set sizes of the knn, extract and pd_layer benches')
+parser.add_argument('--reduce_specs', default='avgpool:4;maxpool:2;rp:1024;sparse_rp:1024;avgpool:4,pca:256', type=str,
+                    help='semicolon separated --tap_reduce specs compared to the full features')
+parser.add_argument('--reduce_samples', default=1000, type=int, help='samples of the synthetic support set of the reduce bench')
+parser.add_argument('--knn_k', default=30, type=int, help='k nearest neighbors of the reduce and pd_layer benches')
+parser.add_argument('--out', default='bench_results.json', type=str, help='file to write the results to')
+parser.add_argument('--compare', default='', type=str, help='results of an earlier run (e.g. another commit) to compare the timings with')
+
+args = parser.parse_args()
+
+
+def _time(fn, iters, warmup):
+    """
+    :return: mean wall time of fn in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters
+
+
+def _ints(values):
+    return [int(v) for v in values.split(',')]
+
+
+def _profile(fn):
+    """
+    run fn once
+    :return: its result, the wall time in seconds and the peak memory of the device in bytes (see
+            instrument.peak_memory)
+    """
+    reset_peak_memory(pd_driver.device)
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start, peak_memory(pd_driver.device)
+
+
+class _SyntheticSet(object):
+    """
+    in-memory dataset in the format pd_driver.TensorLoader serves, see _synthetic_support
+    """
+    def __init__(self, n_samples, seed=0):
+        self.imgs, self.labels = _synthetic_support(n_samples, seed=seed)
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def bench_layers(arch):
+    """
+    number of features and fp32 bytes per sample of every probed layer
+    :return: list of result records
+    """
+    model = get_model(arch).eval()
+    with torch.no_grad():
+        taps = TapRegistry(model)(torch.randn(1, 3, 32, 32))
+    results = [{'bench': 'layers', 'arch': arch, 'layer': k, 'features': tap.shape[1], 'bytes_per_sample': 4 * tap.shape[1]}
+               for k, tap in enumerate(taps)]
+    print('{:10s} {} layers, features per layer: {}'.format(arch, len(taps), [tap.shape[1] for tap in taps]))
+    return results
+
+
+def bench_extract(arch):
+    """
+    time and peak memory of building the support feature banks: all layers in a single pass (_get_feature_banks)
+    and the first layer alone (_get_feature_bank_from_kth_layer), per support set size and bank batch size
+    :return: list of result records
+    """
+    model = export_for_inference(get_model(arch).eval())
+    results = []
+    for support_size in _ints(args.support_sizes):
+        dataset = _SyntheticSet(support_size)
+        for batch_size in _ints(args.batch_sizes):
+            loader = pd_driver.TensorLoader(dataset, batch_size)
+            for stage, fn in (('all_layers', lambda: pd_driver._get_feature_banks(model, loader, 'support')),
+                              ('kth_layer', lambda: pd_driver._get_feature_bank_from_kth_layer(model, loader, 0))):
+                _, seconds, peak_bytes = _profile(fn)
+                results.append({'bench': 'extract', 'arch': arch, 'stage': stage, 'support_size': support_size,
+                                'batch_size': batch_size, 'seconds': seconds, 'peak_bytes': peak_bytes})
+                print('{:10s} extract {:10s} support {:6d} batch {:4d}  {:7.2f} s  peak {}'.format(
+                    arch, stage, support_size, batch_size, seconds, _megabytes(peak_bytes)))
+    return results
+
+
+def bench_knn(arch):
+    """
+    time and peak memory of knn_predict for the smallest, the median and the largest probed layer of the arch, per
+    knn_k, query batch size and support set size (one batch of queries against the whole support set)
+    :return: list of result records
+    """
+    with torch.no_grad():
+        dims = sorted(tap.shape[1] for tap in TapRegistry(get_model(arch).eval())(torch.randn(1, 3, 32, 32)))
+    results = []
+    for dim in sorted({dims[0], dims[len(dims) // 2], dims[-1]}):
+        for support_size in _ints(args.support_sizes):
+            bank = FeatureBank(torch.randn(support_size, dim), torch.randint(0, 10, (support_size,)))
+            for batch_size in _ints(args.batch_sizes):
+                queries = torch.randn(batch_size, dim)
+                for knn_k in _ints(args.knn_ks):
+                    def run():
+                        with torch.no_grad():
+                            return knn_predict(queries, bank, None, classes=10, knn_k=knn_k, knn_t=1,
+                                               tile_size=pd_driver.args.knn_tile_size)
+                    seconds = _time(run, args.iters, args.warmup)
+                    _, _, peak_bytes = _profile(run)
+                    results.append({'bench': 'knn', 'arch': arch, 'features': dim, 'support_size': support_size,
+                                    'batch_size': batch_size, 'knn_k': knn_k, 'seconds': seconds,
+                                    'queries_per_sec': batch_size / seconds, 'peak_bytes': peak_bytes})
+                    print('{:10s} knn F {:6d} support {:6d} batch {:4d} k {:4d}  {:10.1f} queries/s  peak {}'.format(
+                        arch, dim, support_size, batch_size, knn_k, batch_size / seconds, _megabytes(peak_bytes)))
+    return results
+
+
+def bench_pd_layer(arch):
+    """
+    time and peak memory of the knn predictions of a whole split: one layer at a time (get_knn_prds_k_layer, first and
+    last layer) and all layers in a single pass (get_knn_prds_all_layers), per support set size and batch size
+    (evaluated split of the same size as the support set)
+    :return: list of result records
+    """
+    model = export_for_inference(get_model(arch).eval())
+    with torch.no_grad():
+        n_layers = len(TapRegistry(model)(torch.randn(1, 3, 32, 32)))
+    results = []
+    for support_size in _ints(args.support_sizes):
+        support, evaluated = _SyntheticSet(support_size, seed=0), _SyntheticSet(support_size, seed=1)
+        for batch_size in _ints(args.batch_sizes):
+            floader = pd_driver.TensorLoader(support, batch_size)
+            evaloader = pd_driver.TensorLoader(evaluated, batch_size)
+            stages = [('k_layer{}'.format(k), lambda k=k: pd_driver.get_knn_prds_k_layer(model, evaloader, floader, k,
+                                                                                         train_split=False))
+                      for k in (0, n_layers - 1)]
+            stages.append(('all_layers', lambda: pd_driver.get_knn_prds_all_layers(model, evaloader, floader,
+                                                                                   train_split=False)))
+            for stage, fn in stages:
+                _, seconds, peak_bytes = _profile(fn)
+                results.append({'bench': 'pd_layer', 'arch': arch, 'stage': stage, 'support_size': support_size,
+                                'batch_size': batch_size, 'knn_k': pd_driver.args.knn_k, 'seconds': seconds,
+                                'peak_bytes': peak_bytes})
+                print('{:10s} pd {:10s} support {:6d} batch {:4d}  {:7.2f} s  peak {}'.format(
+                    arch, stage, support_size, batch_size, seconds, _megabytes(peak_bytes)))
+    return results
+
+
+def _megabytes(n_bytes):
+    return 'n/a' if n_bytes is None else '{:.0f} MB'.format(n_bytes / 2 ** 20)
+
+
+def _record_key(result):
+    """
+    the settings of a result record, without its measurements
+    """
+    return tuple(sorted((key, value) for key, value in result.items()
+                        if not isinstance(value, float) and not key.endswith(('seconds', 'bytes', 'per_sec'))))
+
+
+def compare_results(baseline, results):
+    """
+    print the time of every record that also is in the baseline relative to the baseline time
+    :param baseline: results of an earlier run, as written to args.out
+    :param results: result records of this run
+    """
+    baseline_seconds = {_record_key(result): result['seconds'] for result in baseline['results'] if 'seconds' in result}
+    print('compared with {} (commit {}):'.format(args.compare, baseline.get('commit')))
+    for result in results:
+        old = baseline_seconds.get(_record_key(result))
+        if old is None or 'seconds' not in result:
+            continue
+        print('{:6.2f}x  {}'.format(result['seconds'] / old, ' '.join('{}={}'.format(*item) for item in _record_key(result))))
+
+
+def _commit():
+    """
+    :return: the git commit of the benchmarked code, None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_precision(arch):
+    """
+    time the single-pass extraction of all probed layers (forward_taps) in fp32 and in bf16 autocast, both in
+    contiguous and in channels-last memory format
+    :return: list of result records
+    """
+    results = []
+    for channels_last in (False, True):
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        model = get_model(arch).eval().to(memory_format=memory_format)
+        x = torch.randn(args.batch_size, 3, 32, 32).to(memory_format=memory_format)
+        for precision in ('fp32', 'bf16'):
+            def run():
+                with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+                    model.forward_taps(x)
+            seconds = _time(run, args.iters, args.warmup)
+            results.append({'bench': 'precision', 'arch': arch, 'precision': precision, 'channels_last': channels_last,
+                            'batch_size': args.batch_size, 'seconds': seconds,
+                            'samples_per_sec': args.batch_size / seconds})
+            print('{:10s} {:5s} channels_last={:d}  {:9.1f} img/s'.format(arch, precision, channels_last,
+                                                                       args.batch_size / seconds))
+    return results
+
+
+def _synthetic_support(n_samples, num_classes=10, seed=0):
+    """
+    images drawn around one random mean image per class, so that the knn labels depend on the features
+    :return: images (N x 3 x 32 x 32) and labels (N)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    labels = torch.randint(0, num_classes, (n_samples,), generator=generator)
+    means = torch.randn(num_classes, 3, 32, 32, generator=generator)
+    return means[labels] + 2 * torch.randn(n_samples, 3, 32, 32, generator=generator), labels
+
+
+def _extract(model, imgs):
+    """
+    :return: taps of all images (list with one N x F tensor per tap) and the extraction time in seconds
+    """
+    start = time.perf_counter()
+    with torch.no_grad():
+        taps = [torch.cat(tap, dim=0) for tap in zip(*[model.forward_taps(batch) for batch in imgs.split(args.batch_size)])]
+    return taps, time.perf_counter() - start
+
+
+def _self_knn_pd(taps, labels):
+    """
+    prediction depth of every sample of the support set against the others (leave one out)
+    :return: prediction depths (N) and the knn time in seconds
+    """
+    start = time.perf_counter()
+    knn_labels = torch.stack([knn_predict_self(FeatureBank(tap, labels), 10, args.knn_k - 1, 1).argmax(1)
+                              for tap in taps], dim=1)
+    return prediction_depths(knn_labels), time.perf_counter() - start
+
+
+def bench_reduce(arch):
+    """
+    feature extraction time, bank memory, knn time and prediction depth agreement of each tap reduction of
+    args.reduce_specs against the full features, on a synthetic support set (PD as for the train split)
+    :return: list of result records
+    """
+    model = export_for_inference(get_model(arch).eval())
+    imgs, labels = _synthetic_support(args.reduce_samples)
+    taps, extract_seconds = _extract(model, imgs)
+    full_pd, knn_seconds = _self_knn_pd(taps, labels)
+    results = [{'bench': 'reduce', 'arch': arch, 'spec': '', 'features_per_sample': sum(tap.shape[1] for tap in taps),
+                'bank_bytes': sum(tap.numel() * tap.element_size() for tap in taps), 'extract_seconds': extract_seconds,
+                'knn_seconds': knn_seconds}]
+    for spec in args.reduce_specs.split(';'):
+        model.tap_reducers = make_tap_reducers(spec, len(taps))
+        if 'pca' in spec:
+            fit_tap_reducers(model, _extract(model, imgs)[0])
+        reduced, extract_seconds = _extract(model, imgs)
+        pd, knn_seconds = _self_knn_pd(reduced, labels)
+        results.append(dict({'bench': 'reduce', 'arch': arch, 'spec': spec,
+                             'features_per_sample': sum(tap.shape[1] for tap in reduced),
+                             'bank_bytes': sum(tap.numel() * tap.element_size() for tap in reduced),
+                             'extract_seconds': extract_seconds, 'knn_seconds': knn_seconds},
+                            **compare_pds(full_pd.numpy(), pd.numpy())))
+    model.tap_reducers = None
+    for result in results:
+        print('{:10s} {:22s} {:8d} feats  {:8.1f} MB  extract {:6.2f} s  knn {:6.2f} s  spearman {:.3f}'.format(
+            arch, result['spec'] or 'full', result['features_per_sample'], result['bank_bytes'] / 2 ** 20,
+            result['extract_seconds'], result['knn_seconds'], result.get('spearman', 1.0)))
+    return results
+
+
+if __name__ == '__main__':
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    results = []
+    pd_driver.args.knn_k = args.knn_k
+    benches = {'layers': bench_layers, 'extract': bench_extract, 'knn': bench_knn, 'pd_layer': bench_pd_layer,
+               'precision': bench_precision, 'reduce': bench_reduce}
+    for bench in args.benches.split(','):
+        for arch in args.archs.split(','):
+            results += benches[bench](arch)
+    with open(args.out, 'w') as f:
+        json.dump({'torch': torch.__version__, 'num_threads': torch.get_num_threads(), 'commit': _commit(),
+                   'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), results)
@@ -0,0 +1,19 @@
+import argparse
+import glob
+import os
+from pd_io import pd_agreement
+
+parser = argparse.ArgumentParser(description='agreement of the prediction depths of two result directories')
+parser.add_argument('reference_dir', type=str, help='results of the reference run (e.g. --knn_index exact)')
+parser.add_argument('result_dir', type=str, help='results to compare (e.g. --knn_index ivf)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for path in sorted(glob.glob(os.path.join(args.reference_dir, '*pd.npz')) +
+                       glob.glob(os.path.join(args.reference_dir, '*pd.pkl'))):
+        other = os.path.join(args.result_dir, os.path.basename(path))
+        if not os.path.exists(other):
+            continue
+        report = pd_agreement(path, other)
+        print('{}: n={n_samples} equal={equal:.3f} within_1={within_1:.3f} mean_abs_diff={mean_abs_diff:.3f} '
+              'spearman={spearman:.3f}'.format(os.path.basename(path), **report))
@@ -1,53 +1,93 @@
 import torch
+import torch.distributed as dist
 from torchvision.transforms import PILToTensor
 import matplotlib.pyplot as plt
-from knndnn import VGGPD, MLP7, ResNetPD, BasicBlockPD
+from knndnn import get_model, export_for_inference, make_tap_reducers, fit_tap_reducers, prediction_depths, TapRegistry, \
+    ModelEnsemble
 from torchvision.datasets import CIFAR10
 import torchvision.transforms as T
-from knndnn import knn_predict
+from knndnn import knn_predict, knn_predict_sweep, knn_predict_self_sweep, knn_weightings, FeatureBank, IVFIndex
+from pd_io import save_pd_result, pd_trajectory_prefix
+from pipeline import Prefetcher
+from instrument import Tracer, set_tracer, stage, event, torch_profile
 from torch.utils.data import DataLoader, Subset
 import torch.nn as nn
-import collections
 import numpy as np
 import json
-from torch.cuda.amp import autocast
 from torch.optim.lr_scheduler import CosineAnnealingLR
-from torchvision.models import vgg16
 from sklearn.model_selection import train_test_split
 import torch.nn.functional as F
 import random
 import warnings
 import argparse
+import collections
+import copy
+import hashlib
+import itertools
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
 parser = argparse.ArgumentParser(description='arguments to compute prediction depth for each data sample')
 parser.add_argument('--train_ratio', default=0.5, type=float, help='ratio of train split / total data split')
 parser.add_argument('--result_dir', default='./cl_results_vgg', type=str, help='directory to save ckpt and results')
 parser.add_argument('--data', default='cifar10', type=str, help='dataset')
-parser.add_argument('--arch', default='vgg', type=str, help='vgg / mlp / resnet')
+parser.add_argument('--arch', default='vgg', type=str, help='vgg / mlp / resnet / resnet_ws / tv_<name> (torchvision model, every conv and linear probed)')
 parser.add_argument('--get_train_pd', default=False, type=bool, help='get prediction depth for training split')
 parser.add_argument('--get_val_pd', default=True, type=bool, help='get prediction depth for validation split')
 parser.add_argument('--resume', default=False, type=bool, help='resume from the ckpt')
+parser.add_argument('--ckpt_cache_dir', default='./ckpt_cache', type=str, help="trained models keyed by the hash of the training config and split, reused instead of training again ('': off)")
 parser.add_argument('--fraction', default=0.4, type=float, help='ratio of noise')
-parser.add_argument('--half', default=False, type=str, help='use amp if GPU memory is 15 GB; set to False if GPU memory is 32 GB ')
+parser.add_argument('--half', default=False, type=str, help='use amp if GPU memory is 15 GB; set to False if GPU memory is 32 GB; bf16 autocast on CPU')
+parser.add_argument('--device', default='', type=str, help='cuda / cpu, defaults to cuda if available')
+parser.add_argument('--channels_last', action='store_true', help='run the model in channels-last memory format')
 parser.add_argument('--num_epochs', default=80, type=int, help='number of epochs for training')
 parser.add_argument('--total_iteration', default=15000, type=str, help='if training process is more than total iteration then stop')
 parser.add_argument('--num_classes', default=10, type=int, help='number of classes')
 parser.add_argument('--num_samples', default=10000, type=int, help='number of samples')
+parser.add_argument('--result_format', default='npz', type=str, help='npz: typed arrays (see pd_io.py) / json: legacy {index: [pd]} .pkl files')
+parser.add_argument('--run_flip', action='store_true', help='also run every seed with the train and val splits swapped')
+parser.add_argument('--seed_workers', default=1, type=int, help='number of processes running seeds concurrently')
+parser.add_argument('--threads_per_worker', default=0, type=int, help='torch threads of each seed process, also of the main process if --seed_workers is 1 (0: torch default)')
+parser.add_argument('--max_retries', default=1, type=int, help='number of times a failed seed is retried')
+parser.add_argument('--tensor_data', action='store_true', help='decode and normalize the dataset once into a tensor and augment training batches on tensors')
 parser.add_argument('--knn_k', default=30, type=int, help='k nearest neighbors of knn classifier')
+parser.add_argument('--no_inference_export', action='store_true', help='extract PD features with the trained model as is, without folding BN into convs')
+parser.add_argument('--knn_dist', default='l2', type=str, help='distance metric of knn classifier: l2 / cos')
+parser.add_argument('--bank_transposed', action='store_true', help='store the feature banks as contiguous F x K matrices')
+parser.add_argument('--bank_batch_size', default=500, type=int, help='batch size used to build the support feature banks')
+parser.add_argument('--bank_dtype', default='fp32', type=str, help='storage dtype of the support feature banks: fp32 / fp16 / bf16')
+parser.add_argument('--feature_cache_dir', default='', type=str, help='directory of memory-mapped per-layer features reused across runs')
+parser.add_argument('--knn_tile_size', default=8192, type=int, help='number of support pts per distance tile in the knn search')
+parser.add_argument('--early_exit', action='store_true', help='skip the knn queries of samples whose prediction depth is already known')
+parser.add_argument('--sweep_knn_k', default='', type=str, help='comma separated knn_k values of a knn sweep, e.g. 10,30,100 (default: --knn_k)')
+parser.add_argument('--sweep_knn_t', default='', type=str, help='comma separated temperatures of a knn sweep, only used by the exp weighting (default: 1)')
+parser.add_argument('--sweep_weighting', default='', type=str, help='comma separated vote weightings of a knn sweep: inverse / uniform / exp (default: inverse)')
+parser.add_argument('--legacy_knn_weights', action='store_true', help='weight knn votes as earlier versions did (reproduction only)')
+parser.add_argument('--no_self_knn', action='store_true', help='extract the evaluated split again even when it is the support set')
+parser.add_argument('--knn_index', default='exact', type=str, help='knn search backend: exact / ivf (approximate, see knndnn.IVFIndex)')
+parser.add_argument('--ivf_lists', default=0, type=int, help='number of k-means clusters of the ivf index (0: sqrt of the support set size)')
+parser.add_argument('--ivf_probe', default=8, type=int, help='number of clusters the ivf index searches per query')
+parser.add_argument('--tap_reduce', default='', type=str, help="reduction of every probed layer before knn, e.g. avgpool:4 / rp:1024 / maxpool:2,pca:256 (see knndnn.make_tap_reducers), 'auto' for the preset of the arch")
+parser.add_argument('--pca_fit_samples', default=2000, type=int, help='number of support samples the pca tap reduction is fit on')
+parser.add_argument('--pipeline_depth', default=0, type=int, help='overlap feature extraction (this many batches ahead) and bank building with the knn search, 0: sequential')
+parser.add_argument('--shard_pd', action='store_true', help='split the knn evaluation across the processes started by torchrun (gloo backend)')
+parser.add_argument('--pd_every', default=0, type=int, help='also compute the PD of a fixed probe subset every this many epochs during training, and of the initialization (0: off)')
+parser.add_argument('--pd_probe_size', default=500, type=int, help='number of probe samples of --pd_every')
+parser.add_argument('--pd_probe_support', default=2000, type=int, help='number of train split samples the probe is compared with (0: the whole train split)')
+parser.add_argument('--pd_probe_split', default='val', type=str, help='split the probe samples are drawn from: val / train (then a subset of the support samples)')
+parser.add_argument('--trace_dir', default='', type=str, help='directory of the per-stage json lines log and Chrome trace of every seed (see instrument.py)')
+parser.add_argument('--ensemble_size', default=1, type=int, help='train this many seeds together as one vmapped model in a single process and extract their PD features in one batched pass (needs --tensor_data, see knndnn.ModelEnsemble)')
+parser.add_argument('--torch_profile', action='store_true', help='also write an operator level torch.profiler trace of every seed to --trace_dir')
 
-args = parser.parse_args()
+# imported (e.g. by bench_pd.py) the defaults are used, spawned seed workers re-run this as __mp_main__ with sys.argv
+args = parser.parse_args() if __name__ in ('__main__', '__mp_main__') else parser.parse_args([])
 
 # hyper parameters
 # change cifar10 as (img, label), index
-if args.arch == 'mlp':
-    'depth index starts from 0 and end with max_prediction_depth - 1'
-    max_prediction_depth = 7
-elif args.arch == 'vgg':
-    max_prediction_depth = 14
-elif args.arch == 'resnet':
-    max_prediction_depth = 10
-
+# the number of probed layers (max prediction depth) is the number of taps of the model, see knndnn.TapRegistry
 lr_init = 0.04
 momentum = 0.9
 lr_decay = 0.2
@@ -55,10 +95,31 @@ if args.arch == 'mlp':
     mile_stones = [1250, 4000, 12000]
 elif args.arch == 'vgg':
     mile_stones = [1000, 5000]
-elif args.arch == 'resnet':
+elif args.arch in ('resnet', 'resnet_ws'):
     mile_stones = [7000]
 
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
+device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
+
+def _autocast():
+    """
+    autocast context of --half: fp16 autocast on GPU, bf16 autocast (its CPU counterpart) on CPU
+    """
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16,
+                          enabled=bool(args.half))
+
+
+def _to_device(imgs):
+    """
+    move a batch of images to the device in the memory format of the model
+    """
+    return imgs.to(device, memory_format=memory_format, non_blocking=True)
+tap_reduce_presets = {'vgg': 'avgpool:4', 'resnet': 'avgpool:4', 'resnet_ws': 'avgpool:4', 'mlp': 'rp:512'}  # --tap_reduce auto
+bank_dtypes = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}  # None keeps the dtype of the model output
+knn_indexes = ('exact', 'ivf')  # --knn_index
+pd_probe_splits = ('val', 'train')  # --pd_probe_split
 
 
 class CIFAR10PD(CIFAR10):
@@ -79,61 +140,414 @@ class CIFAR10PD_save(CIFAR10PD):
         (img, target), index = super(CIFAR10PD_save, self).__getitem__(index)
         return PILToTensor()(img), target, index
 
+cifar_mean, cifar_std = (0.4914, 0.4822, 0.4465), (0.247, 0.243, 0.261)
+
+
+class CIFAR10PDTensor(CIFAR10):
+    """
+    CIFAR10 decoded and normalized once into a contiguous N x 3 x 32 x 32 float tensor, no PIL / transform per image
+    """
+    def __init__(self, root, train=True, download=False):
+        super(CIFAR10PDTensor, self).__init__(root, train, download=download)
+        mean = torch.tensor(cifar_mean).view(1, 3, 1, 1)
+        std = torch.tensor(cifar_std).view(1, 3, 1, 1)
+        self.imgs = ((torch.from_numpy(self.data).permute(0, 3, 1, 2).float() / 255 - mean) / std).contiguous()
+        self.labels = torch.tensor(self.targets, dtype=torch.long)
+
+    def __getitem__(self, index):
+        return (self.imgs[index], self.labels[index]), index
+
+
+def augment_batch(imgs, padding=4, generator=None):
+    """
+    RandomCrop(32, padding=4) and RandomHorizontalFlip on a normalized batch at once
+    :param imgs: normalized images (B x C x H x W)
+    :return: augmented images (B x C x H x W)
+    """
+    B, C, H, W = imgs.shape
+    # pad with black in normalized space, as RandomCrop pads the PIL image before ToTensor / Normalize
+    black = (-torch.tensor(cifar_mean) / torch.tensor(cifar_std)).to(imgs.device, imgs.dtype)
+    padded = black.view(1, C, 1, 1).repeat(B, 1, H + 2 * padding, W + 2 * padding)
+    padded[:, :, padding:padding + H, padding:padding + W] = imgs
+    offsets = torch.randint(0, 2 * padding + 1, (2, B), generator=generator).to(imgs.device)
+    rows = (offsets[0][:, None] + torch.arange(H, device=imgs.device))[:, :, None]  # B x H x 1
+    cols = (offsets[1][:, None] + torch.arange(W, device=imgs.device))[:, None, :]  # B x 1 x W
+    crops = padded.permute(0, 2, 3, 1)[torch.arange(B, device=imgs.device)[:, None, None], rows, cols]  # B x H x W x C
+    crops = crops.permute(0, 3, 1, 2)
+    flip = (torch.rand(B, generator=generator) < 0.5).to(imgs.device)
+    return torch.where(flip[:, None, None, None], crops.flip(3), crops).contiguous()
+
+
+class TensorLoader(object):
+    """
+    DataLoader replacement for a CIFAR10PDTensor (or a Subset of it), batches are served by slicing
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, augment=False, generator=None):
+        """
+        :param dataset: CIFAR10PDTensor or Subset of a CIFAR10PDTensor
+        :param batch_size: batch size
+        :param shuffle: shuffle the samples at every epoch
+        :param augment: apply augment_batch to every batch
+        :param generator: random generator of the shuffling and the augmentation (None: global RNG)
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.generator = generator
+        if isinstance(dataset, Subset):
+            self.base, self.indices = dataset.dataset, torch.as_tensor(np.asarray(dataset.indices), dtype=torch.long)
+        else:
+            self.base, self.indices = dataset, torch.arange(len(dataset))
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        # same format as the DataLoaders: '(img, target), index'
+        indices = self.indices[torch.randperm(len(self.indices), generator=self.generator)] if self.shuffle else self.indices
+        for start in range(0, len(indices), self.batch_size):
+            idx = indices[start:start + self.batch_size]
+            imgs = self.base.imgs[idx]
+            if self.augment:
+                imgs = augment_batch(imgs, generator=self.generator)
+            yield (imgs, self.base.labels[idx]), idx
+
+
 def mile_stone_step(optimizer, curr_iter):
     if curr_iter in mile_stones:
         for param_gp in optimizer.param_groups:
             param_gp['lr'] *= lr_decay
 
 
-def trainer(trainloader, testloader, model, optimizer, num_epochs, criterion, random_sd, flip):
+def trainer(trainloader, testloader, model, optimizer, num_epochs, criterion, random_sd, flip, pd_probe=None):
     curr_iteration = 0
+    if pd_probe is not None:
+        pd_probe(model, 0)
     cos_scheduler = CosineAnnealingLR(optimizer, num_epochs)
     history = {'train_loss': [], 'test_loss': [], 'train_acc': [], 'test_acc': []}
-    print('------ Training started on %s with total number of %d epochs ------'.format(device, num_epochs))
+    print('------ Training started on {} with total number of {} epochs ------'.format(device, num_epochs))
     for epo in range(num_epochs):
         train_acc = 0
         train_num_total = 0
-        for (imgs, labels), idx in trainloader:
-            curr_iteration += 1
-            imgs, labels = imgs.cuda(non_blocking=True), labels.cuda(non_blocking=True)
-            logits = model(imgs, train=True)
-            loss = criterion(logits, labels)
-            prds = logits.argmax(1)
-            train_acc += sum(prds == labels)
-            train_num_total += imgs.shape[0]
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            # mile_stone_step(optimizer, curr_iteration)
+        with stage('train_epoch', epoch=epo) as record:
+            for (imgs, labels), idx in trainloader:
+                curr_iteration += 1
+                imgs, labels = _to_device(imgs), labels.to(device, non_blocking=True)
+                logits = model(imgs)
+                loss = criterion(logits, labels)
+                prds = logits.argmax(1)
+                train_acc += sum(prds == labels)
+                train_num_total += imgs.shape[0]
+
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                # mile_stone_step(optimizer, curr_iteration)
+            record['samples'] = train_num_total
         cos_scheduler.step()
         history['train_loss'].append(loss.item())
         history['train_acc'].append(train_acc.item() / train_num_total)
         print('epoch:', epo, 'lr', optimizer.param_groups[0]['lr'], 'loss', loss.item(), 'train_acc',
               train_acc.item() / train_num_total)
-        torch.save(model.state_dict(), os.path.join(args.result_dir, 'ms{}_{}sgd{}_{}.pt'.format(args.arch, args.data, random_sd, flip)))
-        with torch.no_grad():
+        _save_atomic(model.state_dict(), os.path.join(args.result_dir, 'ms{}_{}sgd{}_{}.pt'.format(args.arch, args.data, random_sd, flip)))
+        with torch.no_grad(), stage('test_epoch', epoch=epo) as record:
             test_acc = 0
             test_num_total = 0
             for (imgs, labels), idx in testloader:
-                imgs, labels = imgs.cuda(non_blocking=True), labels.cuda(non_blocking=True)
-                logits = model(imgs, train=True)
+                imgs, labels = _to_device(imgs), labels.to(device, non_blocking=True)
+                logits = model(imgs)
                 loss = criterion(logits, labels)
                 prds = logits.argmax(1)
                 test_acc += sum(prds == labels)
                 test_num_total += imgs.shape[0]
+            record['samples'] = test_num_total
         print('epoch:', epo, 'lr', optimizer.param_groups[0]['lr'], 'loss', loss.item(), 'test_acc',
               test_acc.item() / test_num_total)
         history['test_loss'].append(loss.item())
         history['test_acc'].append(test_acc.item() / test_num_total)
-        with open(os.path.join(args.result_dir, 'train_test_history_{}_sd{}_{}.pt'.format(args.arch, seed, flip)), 'w') as f:
+        with open(os.path.join(args.result_dir, 'train_test_history_{}_sd{}_{}.pt'.format(args.arch, random_sd, flip)), 'w') as f:
             json.dump(history, f)
+        if pd_probe is not None and (epo + 1) % args.pd_every == 0:
+            pd_probe(model, epo + 1)
 
         if curr_iteration >= args.total_iteration:
             break
     return model
 
 
+def ensemble_trainer(trainloaders, testloader, ensemble, optimizer, num_epochs, criterion, jobs, pd_probes=None):
+    """
+    train the members of a ModelEnsemble together, every member on the batches of its own train loader. Same
+    schedule, ckpts, histories and test pass (in train mode) per member as trainer.
+    :param trainloaders: one TensorLoader per member (same number of batches), with the random generator of its seed
+    :param testloader: loader of the test set, shared by the members
+    :param ensemble: ModelEnsemble of the members
+    :param optimizer: optimizer of ensemble.parameters()
+    :param jobs: (seed, flip) of every member
+    :param pd_probes: PDProbe of every member, None without --pd_every
+    :return: the trained member models
+    """
+    curr_iteration = 0
+    if pd_probes is not None:
+        for pd_probe, model in zip(pd_probes, ensemble.unstack()):
+            pd_probe(model, 0)
+    cos_scheduler = CosineAnnealingLR(optimizer, num_epochs)
+    histories = [{'train_loss': [], 'test_loss': [], 'train_acc': [], 'test_acc': []} for _ in jobs]
+    print('------ Training {} members on {} with total number of {} epochs ------'.format(len(jobs), device, num_epochs))
+    for epo in range(num_epochs):
+        ensemble.train()
+        train_acc = torch.zeros(len(jobs), device=device)
+        train_num_total = 0
+        with stage('train_epoch', epoch=epo, members=len(jobs)) as record:
+            for batches in zip(*trainloaders):
+                curr_iteration += 1
+                imgs = torch.stack([imgs for (imgs, _), _ in batches]).to(device, non_blocking=True)  # N x B x C x H x W
+                labels = torch.stack([labels for (_, labels), _ in batches]).to(device, non_blocking=True)  # N x B
+                logits = ensemble(imgs)
+                losses = torch.stack([criterion(member_logits, member_labels)
+                                      for member_logits, member_labels in zip(logits, labels)])
+                train_acc += (logits.argmax(2) == labels).sum(1)
+                train_num_total += labels.shape[1]
+
+                optimizer.zero_grad()
+                losses.sum().backward()  # the members share no parameters, each gets the gradient of its own loss
+                optimizer.step()
+            record['samples'] = train_num_total * len(jobs)
+        cos_scheduler.step()
+        models = ensemble.unstack()
+        for model, (random_sd, flip) in zip(models, jobs):  # before the test pass, as in trainer
+            _save_atomic(model.state_dict(), os.path.join(args.result_dir, 'ms{}_{}sgd{}_{}.pt'.format(args.arch, args.data, random_sd, flip)))
+        # the test pass stays in train mode as in trainer: BN normalizes with the test batch statistics and updates its
+        # running statistics on the test set
+        with torch.no_grad(), stage('test_epoch', epoch=epo, members=len(jobs)) as record:
+            test_acc = torch.zeros(len(jobs), device=device)
+            test_num_total = 0
+            for (imgs, labels), idx in testloader:
+                imgs, labels = imgs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+                logits = ensemble(imgs, shared=True)
+                test_losses = torch.stack([criterion(member_logits, labels) for member_logits in logits])
+                test_acc += (logits.argmax(2) == labels).sum(1)
+                test_num_total += labels.shape[0]
+            record['samples'] = test_num_total * len(jobs)
+        models = ensemble.unstack()
+        for i, (random_sd, flip) in enumerate(jobs):
+            print('seed', random_sd, flip, 'epoch:', epo, 'lr', optimizer.param_groups[0]['lr'], 'loss',
+                  losses[i].item(), 'train_acc', train_acc[i].item() / train_num_total, 'test_loss',
+                  test_losses[i].item(), 'test_acc', test_acc[i].item() / test_num_total)
+            history = histories[i]
+            history['train_loss'].append(losses[i].item())
+            history['train_acc'].append(train_acc[i].item() / train_num_total)
+            history['test_loss'].append(test_losses[i].item())
+            history['test_acc'].append(test_acc[i].item() / test_num_total)
+            with open(os.path.join(args.result_dir, 'train_test_history_{}_sd{}_{}.pt'.format(args.arch, random_sd, flip)), 'w') as f:
+                json.dump(history, f)
+            if pd_probes is not None and (epo + 1) % args.pd_every == 0:
+                pd_probes[i](models[i], epo + 1)
+
+        if curr_iteration >= args.total_iteration:
+            break
+    return ensemble.unstack()
+
+
+def _save_atomic(state_dict, path):
+    """
+    torch.save through a temporary file, a crash never leaves a truncated checkpoint at path
+    """
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _train_config(train_idx, random_seed, flip, ensemble=False):
+    """
+    everything the trained weights depend on, the key of the checkpoint cache
+    :param ensemble: trained as a member of a ModelEnsemble, its batches are drawn by the generator of its seed
+    """
+    config = {'arch': args.arch, 'data': args.data, 'num_classes': args.num_classes, 'num_samples': args.num_samples,
+              'train_ratio': args.train_ratio, 'fraction': args.fraction, 'num_epochs': args.num_epochs,
+              'total_iteration': int(args.total_iteration), 'half': bool(args.half), 'tensor_data': args.tensor_data,
+              'lr_init': lr_init, 'momentum': momentum, 'batch_size': 128, 'seed': random_seed, 'flip': flip,
+              'train_idx_sha1': hashlib.sha1(np.asarray(train_idx, dtype=np.int64).tobytes()).hexdigest()}
+    if ensemble:
+        config['ensemble'] = True  # only set for ensembles, the keys of the models trained alone stay the same
+    return config
+
+
+def _ckpt_cache_path(config):
+    """
+    path of the cached checkpoint of a training config, None if the cache is disabled
+    """
+    if not args.ckpt_cache_dir:
+        return None
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(args.ckpt_cache_dir, 'ms{}_{}.pt'.format(args.arch, key))
+
+
+def _cache_model(model, config, ckpt_path):
+    """
+    store a trained model in the ckpt cache under the hash of its training config (see _ckpt_cache_path)
+    """
+    os.makedirs(args.ckpt_cache_dir, exist_ok=True)
+    with open(ckpt_path[:-len('.pt')] + '.json', 'w') as f:
+        json.dump(config, f, indent=1)  # written first, the checkpoint marks the entry as complete
+    _save_atomic(model.state_dict(), ckpt_path)
+
+
+def _model_hash(model):
+    """
+    hash of the model weights, identifies the checkpoint the cached features were computed with
+    """
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def _feature_cache_prefix(model, dataloader, split):
+    """
+    path prefix of the cached features of a split, keyed by checkpoint hash, split and the settings affecting features:
+    half, bank dtype, tap reduction (spatial pooling has no state, so it is not covered by the checkpoint hash), memory
+    format and inference export
+    :return: the prefix, or None if the feature cache is disabled
+    """
+    if not args.feature_cache_dir:
+        return None
+    indices = np.asarray(getattr(dataloader.dataset, 'indices', np.arange(len(dataloader.dataset))), dtype=np.int64)
+    split_hash = hashlib.sha1(indices.tobytes()).hexdigest()[:8]
+    os.makedirs(args.feature_cache_dir, exist_ok=True)
+    reduce_hash = hashlib.sha1(_tap_reduce_spec().encode()).hexdigest()[:8]
+    return os.path.join(args.feature_cache_dir, 'fms{}_{}_{}{}_half{}_{}_reduce{}_cl{}_export{}'.format(
+        args.arch, _model_hash(model), split, split_hash, int(bool(args.half)), args.bank_dtype, reduce_hash,
+        int(args.channels_last), int(not args.no_inference_export)))
+
+
+def _rank():
+    """
+    rank of this process with --shard_pd, 0 otherwise
+    """
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def _world_size():
+    """
+    number of processes evaluating PD with --shard_pd, 1 otherwise
+    """
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def _shard_rows(n_samples, batch_size):
+    """
+    contiguous rows of the evaluated samples handled by this process. Shards are made of whole batches, so every knn
+    query batch is the same as in a single process run.
+    :return: first and last (excluded) row
+    """
+    n_batches = (n_samples + batch_size - 1) // batch_size
+    start, end = (n_batches * rank // _world_size() for rank in (_rank(), _rank() + 1))
+    return min(start * batch_size, n_samples), min(end * batch_size, n_samples)
+
+
+def _subset(dataset, rows):
+    """
+    Subset of a dataset or of a Subset, always directly on the base dataset (as TensorLoader expects)
+    """
+    if isinstance(dataset, Subset):
+        return Subset(dataset.dataset, np.asarray(dataset.indices)[rows])
+    return Subset(dataset, np.asarray(rows))
+
+
+def _gather_shards(*tensors):
+    """
+    concatenate the per-process results along dim 0 in rank order, on every process
+    """
+    shards = [None] * _world_size()
+    dist.all_gather_object(shards, [torch.as_tensor(t).cpu() for t in tensors])
+    return [torch.cat(parts, dim=0) for parts in zip(*shards)]
+
+
+def _open_bank(path, shape, dtype):
+    """
+    create a .npy memmap and return it together with a tensor sharing its memory
+    """
+    # numpy has no bfloat16, such banks are stored as their int16 bit pattern
+    np_dtype = np.int16 if dtype == torch.bfloat16 else torch.empty(0, dtype=dtype).numpy().dtype
+    arr = np.lib.format.open_memmap(path, mode='w+', dtype=np_dtype, shape=shape)
+    bank = torch.from_numpy(arr)
+    return arr, bank.view(torch.bfloat16) if dtype == torch.bfloat16 else bank
+
+
+def _load_bank(path, dtype):
+    """
+    memory-map a .npy file written by _open_bank, no data is read until it is used
+    """
+    bank = torch.from_numpy(np.load(path, mmap_mode='c'))  # copy-on-write, so the cache file is never modified
+    return bank.view(torch.bfloat16) if dtype == torch.bfloat16 else bank
+
+
+def _fill_feature_banks(dataloader, forward, cache_prefix=None, out=None):
+    """
+    Stream the dataloader batch by batch into preallocated feature banks
+    :param dataloader: the dataloader, may have any number of batches
+    :param forward: maps a batch of images to a list of B x F feature maps (one per layer)
+    :param cache_prefix: if given, the banks are memory-mapped .npy files with this prefix, reused when they exist
+    :param out: the return of an earlier call on the same dataloader with the same layer shapes, refilled in place
+                instead of allocating new banks (not with cache_prefix)
+    :return: the feature banks (list with one N x F tensor per layer, stored in args.bank_dtype),
+            the all label bank (ground truth label for each datapoint) and the index of each datapoint
+    """
+    meta_path = '{}_meta.json'.format(cache_prefix)
+    if cache_prefix is not None and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        banks = [_load_bank('{}_L{}.npy'.format(cache_prefix, k), getattr(torch, dtype)).to(device)
+                 for k, dtype in enumerate(meta['dtypes'])]
+        all_labels = torch.from_numpy(np.load('{}_labels.npy'.format(cache_prefix))).to(device)
+        indices = torch.from_numpy(np.load('{}_indices.npy'.format(cache_prefix)))
+        print('loaded cached features from', cache_prefix)
+        return banks, all_labels, indices
+
+    # NOTE: dataloader now has the return format of '(img, target), index'
+    n_samples = len(dataloader.dataset)
+    banks, all_labels, indices = out if out is not None else (None, None, torch.empty(n_samples, dtype=torch.long))
+    offset = 0
+    with torch.no_grad():
+        for (img, all_label), idx in dataloader:
+            img = _to_device(img)  # an image from the dataset
+            all_label = all_label.to(device, non_blocking=True)
+            with _autocast():
+                fms = forward(img)
+            if banks is None:
+                # memory peaks at the banks plus the activations of one batch
+                dtypes = [bank_dtypes[args.bank_dtype] or fm.dtype for fm in fms]
+                if cache_prefix is None:
+                    banks = [torch.empty(n_samples, fm.shape[1], dtype=dtype, device=fm.device)
+                             for fm, dtype in zip(fms, dtypes)]
+                else:
+                    arrs, banks = zip(*[_open_bank('{}_L{}.npy.tmp{}'.format(cache_prefix, k, os.getpid()), (n_samples, fm.shape[1]), dtype)
+                                        for k, (fm, dtype) in enumerate(zip(fms, dtypes))])
+                all_labels = torch.empty(n_samples, dtype=all_label.dtype, device=all_label.device)
+            end = offset + img.shape[0]
+            for bank, fm in zip(banks, fms):
+                bank[offset:end] = fm
+            all_labels[offset:end] = all_label
+            indices[offset:end] = idx
+            offset = end
+
+    if cache_prefix is not None:
+        # files are renamed into place only once complete, the meta file marks the whole split as complete
+        for k, arr in enumerate(arrs):
+            arr.flush()
+            os.replace('{}_L{}.npy.tmp{}'.format(cache_prefix, k, os.getpid()), '{}_L{}.npy'.format(cache_prefix, k))
+        np.save('{}_labels.npy'.format(cache_prefix), all_labels.cpu().numpy())
+        np.save('{}_indices.npy'.format(cache_prefix), indices.numpy())
+        with open(meta_path + '.tmp{}'.format(os.getpid()), 'w') as f:
+            json.dump({'dtypes': [str(dtype).replace('torch.', '') for dtype in dtypes]}, f)
+        os.replace(meta_path + '.tmp{}'.format(os.getpid()), meta_path)
+        banks = [bank.to(device) for bank in banks]
+    return banks, all_labels, indices
+
+
 def _get_feature_bank_from_kth_layer(model, dataloader, k):
     """
     Get feature bank from kth layer of the model
@@ -143,22 +557,11 @@ def _get_feature_bank_from_kth_layer(model, dataloader, k):
     :return: the feature bank (k-th layer feature for each datapoint) and
             the all label bank (ground truth label for each datapoint)
     """
-    # NOTE: dataloader now has the return format of '(img, target), index'
+    # the return of model():'None, _fm.view(_fm.shape[0], -1)  # B x (C x F x F)'
+    with stage('feature_banks', layer=k, samples=len(dataloader.dataset)):
+        banks, all_labels, _ = _fill_feature_banks(dataloader, lambda img: [model(img, k, train=False)[1]])
     print(k, 'layer feature bank gotten')
-    with torch.no_grad():
-        for (img, all_label), idx in dataloader:
-            img = img.cuda(non_blocking=True)  # an image from the dataset
-            all_label = all_label.cuda(non_blocking=True)
-
-            # the return of model():'None, _fm.view(_fm.shape[0], -1)  # B x (C x F x F)'
-            if args.half:
-                with autocast():
-                    _, fms = model(img, k, train=False)
-            else:
-                _, fms = model(img, k, train=False)
-    # print("return value from _get_feature_bank_from_kth_layer:\n", "fms:\n", fms, "\nlen of fms: ", len(fms), "\nall_label\n:", all_label, "\nlen of all_label: ", len(all_label))
-
-    return fms, all_label # somehow, the shape of fms is (number of image) * (it's feature map size)
+    return banks[0], all_labels
 
 
 def get_knn_prds_k_layer(model, evaloader, floader, k, train_split=True):
@@ -174,16 +577,13 @@ def get_knn_prds_k_layer(model, evaloader, floader, k, train_split=True):
     knn_conf_gt_all = []  # This statistics can be noisy
     indices_all = []
     f_bank, all_labels = _get_feature_bank_from_kth_layer(model, floader, k)  # get the feature bank and all labels for the support set
-    f_bank = f_bank.t().contiguous()
+    f_bank = FeatureBank(f_bank, all_labels, dist=args.knn_dist, transposed=args.bank_transposed)
     with torch.no_grad():
         for j, ((imgs, labels), idx) in enumerate(evaloader):
-            imgs = imgs.cuda(non_blocking=True)
-            labels_b = labels.cuda(non_blocking=True)
+            imgs = _to_device(imgs)
+            labels_b = labels.to(device, non_blocking=True)
             nm_cls = args.num_classes
-            if args.half:
-                with autocast():
-                    _, inp_f_curr = model(imgs, k, train=False)
-            else:
+            with _autocast():
                 _, inp_f_curr = model(imgs, k, train=False)
             """
             Explanation of the following function:
@@ -192,7 +592,8 @@ def get_knn_prds_k_layer(model, evaloader, floader, k, train_split=True):
             f_bank is the feature bank of the support set, and we know its ground truth label given all_labels
             We want to use information from the support set (f_bank) to predict the label of the image (inp_f_curr)
             """
-            knn_scores = knn_predict(inp_f_curr, f_bank, all_labels, classes=nm_cls, knn_k=args.knn_k, knn_t=1, rm_top1=train_split)  # B x C
+            knn_scores = knn_predict(inp_f_curr, f_bank, all_labels, classes=nm_cls, knn_k=args.knn_k, knn_t=1, rm_top1=train_split,
+                                     legacy_weights=args.legacy_knn_weights, tile_size=args.knn_tile_size)  # B x C
             knn_probs = F.normalize(knn_scores, p=1, dim=1)
             knn_labels_prd = knn_probs.argmax(1)
             knn_conf_gt = knn_probs.gather(dim=1, index=labels_b[:, None])  # B x 1
@@ -205,17 +606,535 @@ def get_knn_prds_k_layer(model, evaloader, floader, k, train_split=True):
     return knn_labels_all, knn_conf_gt_all, indices_all
 
 
-def _get_prediction_depth(knn_labels_all):
+def _set_tap_reducers(model, dataloader, seed):
+    """
+    attach the tap reducers of args.tap_reduce to the model, draw their random projections and fit their PCAs on the
+    first args.pca_fit_samples samples of the dataloader. The drawn projections and fitted PCAs are part of the state
+    dict (covered by the checkpoint hash of the feature cache key), the spec itself is a separate part of the key.
+    """
+    spec = _tap_reduce_spec()
+    if not spec:
+        return
+    taps = []
+    n_samples = 0
+    with torch.no_grad():
+        for (img, _), _ in dataloader:
+            with _autocast():
+                if not taps:
+                    model.tap_reducers = make_tap_reducers(spec, len(TapRegistry(model)), seed=seed).to(device)
+                taps.append(TapRegistry(model)(_to_device(img)))  # the first call draws the random projections
+            n_samples += img.shape[0]
+            if 'pca' not in spec or n_samples >= args.pca_fit_samples:
+                break
+    if 'pca' in spec:
+        fit_tap_reducers(model, [torch.cat(tap, dim=0)[:args.pca_fit_samples] for tap in zip(*taps)])
+    with torch.no_grad():
+        n_features = sum(tap.shape[1] for tap in TapRegistry(model)(_to_device(img[:1])))
+    print('tap reduction {}: {} features per sample'.format(spec, n_features))
+
+
+def _get_feature_banks(model, dataloader, split):
+    """
+    Get the feature banks of every probed layer from a single pass over the dataloader
+    :param model: the model
+    :param dataloader: the dataloader
+    :param split: name of the split, part of the feature cache key
+    :return: the feature banks (list with one N x F tensor per layer),
+            the all label bank (ground truth label for each datapoint) and the index of each datapoint
+    """
+    with stage('feature_banks', split=split, samples=len(dataloader.dataset)):
+        banks, all_labels, indices = _fill_feature_banks(dataloader, TapRegistry(model),
+                                                         _feature_cache_prefix(model, dataloader, split))
+    for k, bank in enumerate(banks):
+        event('feature_bank', split=split, layer=k, features=bank.shape[1], bytes=bank.numel() * bank.element_size())
+    print(len(banks), 'layer feature banks gotten')
+    return banks, all_labels, indices
+
+
+def _make_bank(features, labels, layer=None):
+    """
+    the searchable feature bank of one layer for args.knn_index
+    :param features: features of the support set for this layer (K x F)
+    :param labels: labels of the support set (K)
+    :param layer: index of the layer, only used in the trace
+    """
+    with stage('bank_build', layer=layer, index=args.knn_index, samples=len(labels)):
+        if args.knn_index == 'exact':
+            return FeatureBank(features, labels, dist=args.knn_dist, transposed=args.bank_transposed)
+        elif args.knn_index == 'ivf':
+            return IVFIndex(features, labels, dist=args.knn_dist, transposed=args.bank_transposed,
+                            n_lists=args.ivf_lists or None, n_probe=args.ivf_probe)
+    raise NotImplementedError
+
+
+def _knn_configs():
+    """
+    (knn_k, knn_t, weighting) of every knn configuration evaluated: the main one (--knn_k, temperature 1, inverse
+    distance weights) first, then every other combination of --sweep_knn_k, --sweep_knn_t and --sweep_weighting. All of
+    them are derived from one neighbor search for the largest knn_k.
+    """
+    main_config = (args.knn_k, 1.0, 'inverse')
+    if not (args.sweep_knn_k or args.sweep_knn_t or args.sweep_weighting):
+        return [main_config]
+    knn_ks = [int(k) for k in args.sweep_knn_k.split(',')] if args.sweep_knn_k else [args.knn_k]
+    knn_ts = [float(t) for t in args.sweep_knn_t.split(',')] if args.sweep_knn_t else [1.0]
+    weightings = args.sweep_weighting.split(',') if args.sweep_weighting else ['inverse']
+    if any(weighting not in knn_weightings for weighting in weightings):
+        raise ValueError('unknown --sweep_weighting {}, known: {}'.format(args.sweep_weighting, knn_weightings))
+    return [main_config] + [config for config in itertools.product(knn_ks, knn_ts, weightings) if config != main_config]
+
+
+def _knn_labels_conf(knn_scores, labels):
+    """
+    :param knn_scores: class scores of every knn config (list of B x classes)
+    :param labels: ground truth labels (B)
+    :return: knn labels and knn gt confidences of every knn config (both B x C)
+    """
+    knn_probs = torch.stack([F.normalize(scores, p=1, dim=1) for scores in knn_scores], dim=2)  # B x classes x C
+    return knn_probs.argmax(1), knn_probs.gather(dim=1, index=labels[:, None, None].expand(-1, 1, len(knn_scores))).squeeze(1)
+
+
+def _knn_prds_layer(f_bank, inp_f, labels, batch_size, train_split=True, rows=None, self_knn=False, layer=None):
+    """
+    Get the knn predictions of one layer for every knn config (see _knn_configs)
+    :param f_bank: FeatureBank (or IVFIndex) of the support set for this layer
+    :param inp_f: features of the evaluated samples for this layer (N x F)
+    :param labels: ground truth labels of the evaluated samples (N)
+    :param batch_size: number of samples queried at once
+    :param train_split: whether the evaluated samples are the training set or not
+    :param rows: indices of the samples to evaluate, all samples if None
+    :param self_knn: whether the evaluated samples are the support set itself (inp_f is the bank), each sample is then
+    excluded from its own neighbors by index instead of dropping the nearest neighbor
+    :param layer: index of the layer, only used in the trace
+    :return: knn labels and knn gt confidences of the evaluated samples (both N x C, one column per knn config)
+    """
+    knn_labels = []
+    knn_conf_gt = []
+    configs = _knn_configs()
+    self_configs = [(knn_k - 1, knn_t, weighting) for knn_k, knn_t, weighting in configs]  # without the pt itself
+    n_rows = len(labels) if rows is None else len(rows)
+    if n_rows == 0:
+        return labels.new_empty(0, len(configs)), torch.empty(0, len(configs), device=labels.device)
+    with torch.no_grad(), stage('knn_layer', layer=layer, samples=n_rows, queries=n_rows, support=len(f_bank.labels),
+                                configs=len(configs)):
+        if self_knn and rows is None and isinstance(f_bank, FeatureBank):
+            knn_scores = knn_predict_self_sweep(f_bank, classes=args.num_classes, configs=self_configs,
+                                                tile_size=args.knn_tile_size)  # N x classes per config
+            return _knn_labels_conf(knn_scores, labels)
+        for start in range(0, n_rows, batch_size):
+            if rows is None:
+                inp_f_curr = inp_f[start:start + batch_size]
+                labels_b = labels[start:start + batch_size]
+                rows_b = torch.arange(start, start + len(labels_b), device=labels.device) if self_knn else None
+            else:
+                rows_b = rows[start:start + batch_size]
+                inp_f_curr = inp_f[rows_b.to(inp_f.device)]
+                labels_b = labels[rows_b]
+            if self_knn:
+                knn_scores = knn_predict_sweep(inp_f_curr, f_bank, classes=args.num_classes, configs=self_configs,
+                                               rm_top1=False, tile_size=args.knn_tile_size, self_indices=rows_b)
+            elif args.legacy_knn_weights:
+                knn_scores = [knn_predict(inp_f_curr, f_bank, f_bank.labels, classes=args.num_classes, knn_k=args.knn_k, knn_t=1, rm_top1=train_split,
+                                          legacy_weights=True, tile_size=args.knn_tile_size)]  # B x classes
+            else:
+                knn_scores = knn_predict_sweep(inp_f_curr, f_bank, classes=args.num_classes, configs=configs,
+                                               rm_top1=train_split, tile_size=args.knn_tile_size)  # B x classes per config
+            knn_labels_b, knn_conf_gt_b = _knn_labels_conf(knn_scores, labels_b)
+            knn_labels.append(knn_labels_b)
+            knn_conf_gt.append(knn_conf_gt_b)
+    return torch.cat(knn_labels, dim=0), torch.cat(knn_conf_gt, dim=0)
+
+
+def _layer_banks(f_banks, all_labels, layers):
+    """
+    searchable feature banks of the given layers, in order. With args.pipeline_depth, the bank of the next layer is
+    built in the background while the current one is searched.
+    :return: iterable of (layer, bank)
+    """
+    banks = ((k, _make_bank(f_banks[k], all_labels, k)) for k in layers)
+    return Prefetcher(banks, depth=1, name='bank build') if args.pipeline_depth else banks
+
+
+def _check_knn_args():
+    """
+    raise a ValueError for unknown knn arguments and for knn arguments that cannot be combined
+    """
+    if args.knn_index not in knn_indexes:
+        raise ValueError('unknown --knn_index {}, known: {}'.format(args.knn_index, knn_indexes))
+    if args.legacy_knn_weights and args.knn_index != 'exact':
+        raise ValueError('--legacy_knn_weights needs --knn_index exact')
+    if len(_knn_configs()) > 1 and (args.early_exit or args.legacy_knn_weights):
+        raise ValueError('a knn sweep needs the knn labels of every layer, no --early_exit or --legacy_knn_weights')
+
+
+def _knn_prds_streamed(model, dataloader, f_banks, all_labels, train_split=True):
+    """
+    Get the knn predictions for every layer batch by batch, as the batches are extracted. With args.pipeline_depth, the
+    forward pass of the next args.pipeline_depth batches runs in the background while the current batch is searched.
+    The features of the evaluated samples are never stored.
+    :param model: the model
+    :param dataloader: the evaluation dataloader
+    :param f_banks: feature banks of the support set (list with one K x F tensor per layer), consumed: every entry is
+                    set to None once its searchable bank is built
+    :param all_labels: labels of the support set (K)
+    :param train_split: whether the evaluated samples are the training set or not
+    :return: knn labels and knn gt confidences (both N x L x C) and the indices of the evaluated samples
+    """
+    _check_knn_args()
+    banks = []
+    for k in range(len(f_banks)):
+        banks.append(_make_bank(f_banks[k], all_labels, k))
+        # the banks of all layers are searched at once: an IVFIndex (sorted) or --bank_transposed bank holds its own
+        # copy of the features, the source is released so that only one layer is held twice at a time
+        f_banks[k] = None
+    taps = TapRegistry(model)
+
+    def extract():
+        # runs in the producer thread, grad mode and autocast are thread local
+        with torch.no_grad():
+            for (img, labels), idx in dataloader:
+                with _autocast():
+                    fms = taps(_to_device(img))
+                yield [fm.to(bank_dtypes[args.bank_dtype] or fm.dtype) for fm in fms], labels.to(device), idx
+
+    batches = Prefetcher(extract(), depth=args.pipeline_depth, name='extract') if args.pipeline_depth else extract()
+    knn_labels_all, knn_conf_gt_all, indices_all = [], [], []
+    for fms, labels, idx in batches:
+        knn_labels, knn_conf_gt = zip(*[_knn_prds_layer(bank, fm, labels, dataloader.batch_size, train_split, layer=k)
+                                        for k, (bank, fm) in enumerate(zip(banks, fms))])
+        knn_labels_all.append(torch.stack(knn_labels, dim=1))
+        knn_conf_gt_all.append(torch.stack(knn_conf_gt, dim=1))
+        indices_all.append(torch.as_tensor(idx))
+    if isinstance(batches, Prefetcher):
+        print('pipeline', batches.report('knn'))
+        event('pipeline', **batches.utilization())
+    return torch.cat(knn_labels_all, dim=0), torch.cat(knn_conf_gt_all, dim=0), torch.cat(indices_all, dim=0)
+
+
+def _knn_prds_features(f_banks, all_labels, inp_fs, labels, n_samples, batch_size, train_split=True, self_knn=False,
+                       shard_rows=None, row_offset=0):
     """
-    get prediction depth for a sample. reverse knn labels list and increase the counter until the label is different
-    :param knn_labels_all:
-    :return:
+    Get the knn predictions for every layer from the extracted features, see get_knn_prds_all_layers
+    :param f_banks: feature banks of the support set (list with one K x F tensor per layer)
+    :param all_labels: labels of the support set (K)
+    :param inp_fs: features of the evaluated samples (list with one tensor per layer), f_banks if self_knn
+    :param labels: ground truth labels of the rows of inp_fs
+    :param n_samples: number of evaluated samples (N)
+    :param batch_size: number of samples queried at once
+    :param train_split: whether the evaluated samples are the training set or not
+    :param self_knn: whether the evaluated samples are the support set itself
+    :param shard_rows: rows of inp_fs evaluated by this process (with self_knn and args.shard_pd), None: all rows
+    :param row_offset: row of inp_fs of the first evaluated sample
+    :return: knn labels and knn gt confidences (both N x L x C, C knn configs, see _knn_configs)
     """
-    pd = 0
-    knn_labels_all = list(reversed(knn_labels_all))
-    while knn_labels_all[pd] == knn_labels_all[0] and pd <= max_prediction_depth - 2:
-        pd += 1
-    return max_prediction_depth - pd
+    _check_knn_args()
+    n_layers = len(f_banks)
+    banks = _layer_banks(f_banks, all_labels, range(n_layers) if not args.early_exit else range(n_layers - 1, 0, -1))
+    if not args.early_exit:
+        knn_labels_all, knn_conf_gt_all = zip(*[  # This statistics can be noisy
+            _knn_prds_layer(f_bank, inp_fs[k], labels, batch_size, train_split, shard_rows,
+                            self_knn=self_knn, layer=k)
+            for k, f_bank in banks])
+        knn_labels_all, knn_conf_gt_all = torch.stack(knn_labels_all, dim=1), torch.stack(knn_conf_gt_all, dim=1)
+    else:
+        # early exit is only defined for the main knn config (no sweep)
+        knn_labels_all = torch.full((n_samples, n_layers, 1), -1, dtype=torch.long, device=labels.device)
+        knn_conf_gt_all = torch.full((n_samples, n_layers, 1), float('nan'), device=labels.device)
+        rows = torch.arange(n_samples, device=labels.device)
+        n_queries = 0
+        # the prediction depth only depends on the deepest layer disagreeing with the last one, and never on layer 0
+        for k, f_bank in banks:
+            knn_labels, knn_conf_gt = _knn_prds_layer(f_bank, inp_fs[k], labels, batch_size, train_split,
+                                                      rows + row_offset, self_knn=self_knn, layer=k)
+            knn_labels_all[rows, k] = knn_labels
+            knn_conf_gt_all[rows, k] = knn_conf_gt.float()
+            n_queries += len(rows)
+            rows = rows[knn_labels[:, 0] == knn_labels_all[rows, -1, 0]]  # samples whose depth is not determined yet
+            if len(rows) == 0:
+                break
+        print('early exit: {} of {} knn queries ({:.1f}% saved)'.format(
+            n_queries, n_samples * n_layers, 100 * (1 - n_queries / max(n_samples * n_layers, 1))))
+        event('early_exit', queries=n_queries, total_queries=n_samples * n_layers)
+    if isinstance(banks, Prefetcher):
+        banks.close()
+        print('pipeline', banks.report('knn'))
+        event('pipeline', **banks.utilization())
+    return knn_labels_all, knn_conf_gt_all
+
+
+def get_knn_prds_all_layers(model, evaloader, floader, train_split=True, split='val'):
+    """
+    Get the knn predictions for every layer, each image goes through the model once per split.
+    When the evaluated split is the support set itself, its features are only extracted once and reused as the queries.
+    With args.early_exit, layers are walked from the softmax layer downward and a sample is dropped as soon as its
+    prediction depth is known, the knn labels and confidences of the layers it skipped are -1 and nan.
+    With args.shard_pd, every process evaluates a contiguous shard of the samples against the whole support set and
+    the shards are gathered on every process.
+    The features of the evaluated samples are only stored to be cached (args.feature_cache_dir) or for args.early_exit,
+    otherwise every batch is searched as it is extracted, overlapped with the extraction of the next ones with
+    args.pipeline_depth (see _knn_prds_streamed).
+    :param model: the model
+    :param evaloader: the evaluation dataloader (training or validation)
+    :param floader: the feature dataloader (support set)
+    :param train_split: whether the evaloader is the training set or not
+    :param split: name of the evaluated split, part of the feature cache key
+    :return: knn labels and knn gt confidences (both N x L x C, C knn configs, see _knn_configs) and the indices of the
+            evaluated samples
+    """
+    sharded = _world_size() > 1
+    if sharded and args.feature_cache_dir and _rank() != 0:
+        dist.barrier()  # rank 0 fills the support cache first, the other processes then memory-map it
+    f_banks, all_labels, support_indices = _get_feature_banks(model, floader, 'support')  # get the feature banks and all labels for the support set
+    if sharded and args.feature_cache_dir and _rank() == 0:
+        dist.barrier()
+    self_knn = (train_split and evaloader.dataset is floader.dataset and not args.no_self_knn
+                and not args.legacy_knn_weights)
+    start, end = _shard_rows(len(evaloader.dataset), evaloader.batch_size)
+    row_offset = 0  # row of inp_fs of the first sample of this process
+    eval_loader = evaloader
+    if sharded and not self_knn and start != end:
+        eval_loader = _get_loader(_subset(evaloader.dataset, np.arange(start, end)), evaloader.batch_size,
+                                  shuffle=False, num_workers=getattr(evaloader, 'num_workers', 0))
+    streamed = not args.feature_cache_dir and not self_knn and not args.early_exit and start != end
+    if streamed:
+        knn_labels_all, knn_conf_gt_all, indices_all = _knn_prds_streamed(model, eval_loader, f_banks, all_labels,
+                                                                          train_split)
+        if sharded:
+            knn_labels_all, knn_conf_gt_all, indices_all = _gather_shards(knn_labels_all, knn_conf_gt_all, indices_all)
+        return knn_labels_all, knn_conf_gt_all, indices_all.numpy()
+    if self_knn:
+        inp_fs, labels, indices_all = f_banks, all_labels, support_indices[start:end]  # the support set queries itself
+        row_offset = start
+    elif start == end:
+        # more processes than batches, this process only takes part in the gather
+        inp_fs, labels, indices_all = [f_bank[:0] for f_bank in f_banks], all_labels[:0], support_indices[:0]
+    else:
+        # features of the evaluated samples (of the shard of this process)
+        inp_fs, labels, indices_all = _get_feature_banks(model, eval_loader, split)
+    shard_rows = torch.arange(start, end, device=labels.device) if self_knn and sharded else None
+    knn_labels_all, knn_conf_gt_all = _knn_prds_features(f_banks, all_labels, inp_fs, labels, len(indices_all),
+                                                         evaloader.batch_size, train_split, self_knn, shard_rows,
+                                                         row_offset)
+    if sharded:
+        knn_labels_all, knn_conf_gt_all, indices_all = _gather_shards(knn_labels_all, knn_conf_gt_all, indices_all)
+    return knn_labels_all, knn_conf_gt_all, indices_all.numpy()
+
+
+def _pd_results(knn_labels, knn_conf_gt):
+    """
+    prediction depths of every knn config
+    :param knn_labels: knn labels (N x L x C, C knn configs, see _knn_configs)
+    :param knn_conf_gt: knn gt confidences (N x L x C)
+    :return: knn labels (N x L), knn gt confidences (N x L) and prediction depths (N) of the main knn config as numpy
+            arrays, and the sweep over all knn configs (see pd_io.save_pd_result, None without a sweep)
+    """
+    configs = _knn_configs()
+    pds = [prediction_depths(knn_labels[:, :, c]) for c in range(len(configs))]
+    sweep = None
+    if len(configs) > 1:
+        knn_ks, knn_ts, weightings = zip(*configs)
+        sweep = {'knn_k': np.array(knn_ks), 'knn_t': np.array(knn_ts), 'weighting': np.array(weightings),
+                 'pd': torch.stack(pds).cpu().numpy(), 'knn_labels': knn_labels.permute(2, 0, 1).cpu().numpy(),
+                 'knn_conf_gt': knn_conf_gt.permute(2, 0, 1).float().cpu().numpy()}
+    return knn_labels[:, :, 0].cpu().numpy(), knn_conf_gt[:, :, 0].cpu().numpy(), pds[0].cpu().numpy(), sweep
+
+
+def get_pd_split(model, evaloader, floader, train_split=True, split='val'):
+    """
+    Get the prediction depth of every sample of a split
+    :return: indices of the samples (N), knn labels (N x L), knn gt confidences (N x L) and prediction depths (N),
+            all as numpy arrays, and the knn sweep (see _pd_results)
+    """
+    start = time.perf_counter()
+    with stage('pd_split', split=split, samples=len(evaloader.dataset)):
+        knn_labels, knn_conf_gt, indices = get_knn_prds_all_layers(model, evaloader, floader, train_split=train_split,
+                                                                   split=split)
+        knn_labels, knn_conf_gt, pds, sweep = _pd_results(knn_labels, knn_conf_gt)
+    print('{} pd ({} knn) computed in {:.1f} s'.format(split, args.knn_index, time.perf_counter() - start))
+    return indices, knn_labels, knn_conf_gt, pds, sweep
+
+
+def _get_feature_banks_ensemble(ensemble, dataloaders, split):
+    """
+    Get the feature banks of every probed layer of every member of an ensemble from a single batched pass, the
+    counterpart of _get_feature_banks (without feature cache)
+    :param ensemble: ModelEnsemble of the members
+    :param dataloaders: one TensorLoader per member, same number of samples and batch size
+    :param split: name of the split
+    :return: per member: the feature banks (list with one N x F tensor per layer), the all label bank and the index of
+            each datapoint
+    """
+    n_samples = len(dataloaders[0].dataset)
+    if any(len(dataloader.dataset) != n_samples for dataloader in dataloaders):
+        raise ValueError('the splits of the members of an ensemble must have the same size')
+    banks = None
+    all_labels = torch.empty(len(dataloaders), n_samples, dtype=torch.long, device=device)
+    indices = torch.empty(len(dataloaders), n_samples, dtype=torch.long)
+    offset = 0
+    with torch.no_grad(), stage('feature_banks', split=split, members=len(dataloaders),
+                                samples=n_samples * len(dataloaders)):
+        for batches in zip(*dataloaders):
+            imgs = torch.stack([img for (img, _), _ in batches]).to(device, non_blocking=True)  # N x B x C x H x W
+            with _autocast():
+                fms = ensemble.forward_taps(imgs)  # N x B x F per layer
+            if banks is None:
+                banks = [torch.empty(len(dataloaders), n_samples, fm.shape[2], device=fm.device,
+                                     dtype=bank_dtypes[args.bank_dtype] or fm.dtype) for fm in fms]
+            end = offset + imgs.shape[1]
+            for bank, fm in zip(banks, fms):
+                bank[:, offset:end] = fm
+            all_labels[:, offset:end] = torch.stack([labels for (_, labels), _ in batches])
+            indices[:, offset:end] = torch.stack([torch.as_tensor(idx) for _, idx in batches])
+            offset = end
+    for k, bank in enumerate(banks):
+        event('feature_bank', split=split, layer=k, features=bank.shape[2], bytes=bank.numel() * bank.element_size())
+    print(len(banks), 'layer feature banks of', len(dataloaders), 'members gotten')
+    return [([bank[i] for bank in banks], all_labels[i], indices[i]) for i in range(len(dataloaders))]
+
+
+def get_pd_split_ensemble(ensemble, evaloaders, support, train_split=True, split='val'):
+    """
+    Get the prediction depth of every sample of a split for every member of an ensemble, the features of all members
+    are extracted in one batched pass
+    :param ensemble: ModelEnsemble of the members
+    :param evaloaders: one evaluation TensorLoader per member
+    :param support: feature banks of the support sets of the members, see _get_feature_banks_ensemble
+    :param train_split: whether the evaluated samples are the training sets or not
+    :param split: name of the evaluated split
+    :return: per member: see get_pd_split
+    """
+    start = time.perf_counter()
+    self_knn = train_split and not args.no_self_knn and not args.legacy_knn_weights
+    results = []
+    with stage('pd_split', split=split, members=len(ensemble), samples=sum(len(loader.dataset) for loader in evaloaders)):
+        evaluated = support if self_knn else _get_feature_banks_ensemble(ensemble, evaloaders, split)
+        for (f_banks, all_labels, _), (inp_fs, labels, indices), evaloader in zip(support, evaluated, evaloaders):
+            knn_labels, knn_conf_gt = _knn_prds_features(f_banks, all_labels, inp_fs, labels, len(indices),
+                                                         evaloader.batch_size, train_split, self_knn)
+            results.append((indices.numpy(),) + _pd_results(knn_labels, knn_conf_gt))
+    print('{} pd ({} knn) of {} members computed in {:.1f} s'.format(split, args.knn_index, len(ensemble),
+                                                                      time.perf_counter() - start))
+    return results
+
+
+class PDProbe(object):
+    """
+    Prediction depth of a fixed probe subset during training (--pd_every): the probe samples are compared with a fixed
+    subset of the train split through a frozen copy of the model, features of all layers in a single pass. The feature
+    banks are allocated at the first evaluation and refilled at every later one, so an evaluation costs a forward pass
+    over both subsets and their knn search. Every evaluation is saved right away (see pd_io.load_pd_trajectory).
+    """
+    def __init__(self, dataset, train_idx, val_idx, random_seed, flip):
+        """
+        :param dataset: the dataset the splits index
+        :param train_idx: indices of the train split (the support set)
+        :param val_idx: indices of the val split
+        :param random_seed: seed of the run, draws the subsets and the tap reductions
+        :param flip: flip of the run, part of the result paths
+        """
+        if args.pd_probe_split not in pd_probe_splits:
+            raise ValueError('unknown --pd_probe_split {}, known: {}'.format(args.pd_probe_split, pd_probe_splits))
+        rng = np.random.RandomState(random_seed)
+        n_support = min(args.pd_probe_support or len(train_idx), len(train_idx))
+        support_idx = np.sort(rng.choice(np.asarray(train_idx), n_support, replace=False))
+        if args.pd_probe_split == 'train':
+            # the probe samples are support samples, they are excluded from their own neighbors (rm_top1)
+            probe_idx = np.sort(rng.choice(support_idx, min(args.pd_probe_size, n_support), replace=False))
+        else:
+            probe_idx = np.sort(rng.choice(np.asarray(val_idx), min(args.pd_probe_size, len(val_idx)), replace=False))
+        self.supportloader = _get_loader(Subset(dataset, support_idx), batch_size=args.bank_batch_size, shuffle=False,
+                                         num_workers=1)
+        self.probeloader = _get_loader(Subset(dataset, probe_idx), batch_size=200, shuffle=False, num_workers=1)
+        self.random_seed = random_seed
+        self.path_prefix = pd_trajectory_prefix(_pd_result_path(args.pd_probe_split, random_seed, flip))
+        os.makedirs(os.path.dirname(self.path_prefix), exist_ok=True)
+        self.support = None  # feature banks, labels and indices, refilled at every evaluation
+        self.probe = None
+
+    def __call__(self, model, epoch):
+        """
+        compute and save the PD of the probe samples. The random state is restored afterwards (the DataLoaders draw
+        from it), training continues as it would without the probe
+        :param model: the model being trained, left as it is
+        :param epoch: number of epochs trained so far
+        """
+        rng_devices = [device] if torch.device(device).type == 'cuda' else []
+        with torch.random.fork_rng(devices=rng_devices), torch.no_grad(), \
+                stage('epoch_pd', epoch=epoch, samples=len(self.probeloader.dataset)):
+            # BN uses its running statistics, as in the PD of the final model
+            frozen = copy.deepcopy(model).eval() if args.no_inference_export else export_for_inference(model)
+            _set_tap_reducers(frozen, self.supportloader, self.random_seed)
+            taps = TapRegistry(frozen)
+            self.support = _fill_feature_banks(self.supportloader, taps, out=self.support)
+            self.probe = _fill_feature_banks(self.probeloader, taps, out=self.probe)
+            (f_banks, all_labels, _), (inp_fs, labels, indices) = self.support, self.probe
+            knn_labels, knn_conf_gt = _knn_prds_features(f_banks, all_labels, inp_fs, labels, len(indices),
+                                                         self.probeloader.batch_size,
+                                                         train_split=args.pd_probe_split == 'train')
+            knn_labels, knn_conf_gt, pds, sweep = _pd_results(knn_labels, knn_conf_gt)
+            save_pd_result('{}_epoch{}.npz'.format(self.path_prefix, epoch), indices.numpy(), knn_labels, knn_conf_gt,
+                           pds, sweep)
+        print('epoch {} probe pd: mean {:.2f}'.format(epoch, pds.mean()))
+
+
+def _pd_result_path(split, random_seed, flip):
+    """
+    path of the prediction depth result of a split ('train' or 'val') without extension
+    """
+    if split == 'train':
+        return os.path.join(args.result_dir, 'ms{}train_seed{}_f{}_trainpd'.format(args.arch, random_seed, flip))
+    return os.path.join(args.result_dir, 'ms{}_seed{}_f{}_test_pd'.format(args.arch, random_seed, flip))
+
+
+def _tap_reduce_spec():
+    """
+    the tap reduction of args.tap_reduce, 'auto' resolved to the preset of the arch ('' for none)
+    """
+    return tap_reduce_presets.get(args.arch, '') if args.tap_reduce == 'auto' else args.tap_reduce
+
+
+def _pd_config():
+    """
+    everything a PD result depends on besides the seed and flip in its file name: the training settings and the
+    feature and knn settings. Saved next to every result, a job is only skipped as done when it matches.
+    """
+    return {'arch': args.arch, 'data': args.data, 'num_classes': args.num_classes, 'num_samples': args.num_samples,
+            'train_ratio': args.train_ratio, 'fraction': args.fraction, 'num_epochs': args.num_epochs,
+            'total_iteration': int(args.total_iteration), 'half': bool(args.half), 'tensor_data': args.tensor_data,
+            'ensemble': args.ensemble_size > 1, 'channels_last': args.channels_last,
+            'inference_export': not args.no_inference_export, 'tap_reduce': _tap_reduce_spec(),
+            'pca_fit_samples': args.pca_fit_samples, 'bank_dtype': args.bank_dtype, 'knn_dist': args.knn_dist,
+            'knn_index': args.knn_index, 'ivf_lists': args.ivf_lists, 'ivf_probe': args.ivf_probe,
+            'knn_configs': [list(config) for config in _knn_configs()], 'legacy_knn_weights': args.legacy_knn_weights,
+            'self_knn': not args.no_self_knn, 'early_exit': args.early_exit}
+
+
+def _pd_config_path(path):
+    """
+    :param path: path of a result file without extension
+    :return: path of the json file with the _pd_config of the result
+    """
+    return path + '_config.json'
+
+
+def _save_pd(path, indices, knn_labels, knn_conf_gt, pds, sweep=None):
+    """
+    save the prediction depth result of a split in args.result_format, and its _pd_config
+    :param path: path of the result file without extension
+    :param sweep: prediction depths of every knn config, see _pd_results (npz only)
+    """
+    config_path = _pd_config_path(path)
+    path += '.npz' if args.result_format == 'npz' else '.pkl'
+    with stage('save_result', path=path, samples=len(pds)) as record:
+        if args.result_format == 'npz':
+            save_pd_result(path, indices, knn_labels, knn_conf_gt, pds, sweep)
+        else:
+            with open(path, 'w') as f:
+                json.dump({int(idx): [pd] for idx, pd in zip(indices, pds.tolist())}, f)
+        record['bytes'] = os.path.getsize(path)
+        with open(config_path, 'w') as f:
+            json.dump(_pd_config(), f, indent=1)  # written last, it marks the result as complete
+
 
 def set_seed(seed=1234):
     if seed is not None:
@@ -229,7 +1148,21 @@ def set_seed(seed=1234):
                     'You may see unexpected behavior when restarting '
                     'from checkpoints.')
 
-def main(train_idx, val_idx, random_seed=1234, flip=''):
+def _get_loader(dataset, batch_size, shuffle, num_workers, augment=False):
+    """
+    TensorLoader with --tensor_data (augment only applies there, the DataLoader datasets carry their transform),
+    DataLoader otherwise
+    """
+    if args.tensor_data:
+        return TensorLoader(dataset, batch_size, shuffle=shuffle, augment=augment)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=torch.device(device).type == 'cuda')
+
+
+def _get_datasets():
+    """
+    :return: the dataset the train / val splits are drawn from and the test set
+    """
     # for simplicity, we do not use data augmentation when measuring difficulty
     # CIFAR10 w / 40% (Fixed) Randomized Labels
     # only the training dataset is shuffle. Datasets for prediction depth and testing remains the same as cifar10 original
@@ -242,7 +1175,11 @@ def main(train_idx, val_idx, random_seed=1234, flip=''):
     test_transform = T.Compose([T.ToTensor(),
                                 T.Normalize(mean=[0.4914, 0.4822, 0.4465], std=(0.247, 0.243, 0.261))
                                 ])
-    if args.data == 'cifar10':
+    if args.data == 'cifar10' and args.tensor_data:
+        # PD passes see the un-augmented images, the train loader augments its batches
+        trainset = CIFAR10PDTensor('./', train=False, download=True)
+        testset = CIFAR10PDTensor('./', train=True, download=True)
+    elif args.data == 'cifar10':
         trainset = CIFAR10PD('./', transform=train_transform, train=False, download=True)
         testset = CIFAR10PD('./', transform=test_transform, train=True, download=True)
 
@@ -253,7 +1190,11 @@ def main(train_idx, val_idx, random_seed=1234, flip=''):
         #     json.dump(cifar_with_index, f)
     else:
         raise NotImplementedError
+    return trainset, testset
+
 
+def main(train_idx, val_idx, random_seed=1234, flip=''):
+    trainset, testset = _get_datasets()
 
     # # print whether the index 1198 image is a horse or no to verify if the index is consistent:
     # (img, target), index = testset[1198]
@@ -271,80 +1212,305 @@ def main(train_idx, val_idx, random_seed=1234, flip=''):
     train_split = Subset(trainset, train_idx)
     supportset = train_split
     val_split = Subset(trainset, val_idx)
-    trainloader = DataLoader(train_split, batch_size=128, shuffle=True, num_workers=2, pin_memory=True)
-    testloader = DataLoader(testset, batch_size=1000, shuffle=False, num_workers=2, pin_memory=True)
+    trainloader = _get_loader(train_split, batch_size=128, shuffle=True, num_workers=2, augment=True)
+    testloader = _get_loader(testset, batch_size=1000, shuffle=False, num_workers=2)
 
-    supportloader = DataLoader(supportset, batch_size=len(supportset), shuffle=False, num_workers=1, pin_memory=True)
+    supportloader = _get_loader(supportset, batch_size=args.bank_batch_size, shuffle=False, num_workers=1)
     if args.get_train_pd:
         # pd (train) data order follows train_indices
-        evaluate_loader_train = DataLoader(train_split, batch_size=200, shuffle=False, num_workers=1, pin_memory=True)
+        evaluate_loader_train = _get_loader(train_split, batch_size=200, shuffle=False, num_workers=1)
     if args.get_val_pd:
         # pd (val) data order follows val_indices
-        evaluate_loader_test = DataLoader(val_split, batch_size=200, shuffle=False, num_workers=1, pin_memory=True)
-
-    if args.arch == 'mlp':
-        model = MLP7(args.num_classes)
-    elif args.arch == 'vgg':
-        ecd = vgg16().features
-        model = VGGPD(ecd, args.num_classes)
-    elif args.arch == 'resnet':
-        model = ResNetPD(BasicBlockPD, [2, 2, 2, 2], temp=1.0)
-    else:
-        raise NotImplementedError
+        evaluate_loader_test = _get_loader(val_split, batch_size=200, shuffle=False, num_workers=1)
+
+    model = get_model(args.arch, args.num_classes)
 
 
-    model = model.to(device)
+    model = model.to(device, memory_format=memory_format)
     criterion = nn.CrossEntropyLoss()
 
 
     optimizer = torch.optim.SGD(model.parameters(), lr=lr_init, momentum=momentum)
-    if not args.resume:
-        model = trainer(trainloader, testloader, model, optimizer, args.num_epochs, criterion, random_seed, flip)
-    else:
-        print('loading model from ckpt')
-        model.load_state_dict(torch.load(os.path.join(args.result_dir, 'ms{}_{}sgd{}_{}.pt'.format(args.arch, args.data, random_seed, flip))))
+    if _rank() == 0:  # with --shard_pd only rank 0 trains / loads the model, it is broadcast below
+        config = _train_config(train_idx, random_seed, flip)
+        ckpt_path = _ckpt_cache_path(config)
+        # --pd_every needs the training to compute the PD during it, a cached model is trained again (and re-cached,
+        # the probe does not change the weights)
+        if not args.resume and not args.pd_every and ckpt_path is not None and os.path.exists(ckpt_path):
+            print('loading cached model', ckpt_path)
+            model.load_state_dict(torch.load(ckpt_path, map_location=device))
+        elif not args.resume:
+            pd_probe = PDProbe(trainset, train_idx, val_idx, random_seed, flip) if args.pd_every else None
+            with stage('train', epochs=args.num_epochs):
+                model = trainer(trainloader, testloader, model, optimizer, args.num_epochs, criterion, random_seed, flip,
+                                pd_probe)
+            if ckpt_path is not None:
+                _cache_model(model, config, ckpt_path)
+        else:
+            print('loading model from ckpt')
+            model.load_state_dict(torch.load(os.path.join(args.result_dir, 'ms{}_{}sgd{}_{}.pt'.format(args.arch, args.data, random_seed, flip)),
+                                             map_location=device))
+    if _world_size() > 1:
+        # the other ranks may be on other hosts, the weights are sent instead of read from the ckpt
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src=0)
 
+    # BN has to use its running statistics during PD, otherwise the features depend on how the samples are batched
+    model.eval()
+    if not args.no_inference_export:
+        # the model is frozen from here on, fold BN / weight standardization once for all bank and eval passes
+        model = export_for_inference(model).to(memory_format=memory_format)
+    _set_tap_reducers(model, supportloader, random_seed)
     if args.get_train_pd:
-        index_knn_y = collections.defaultdict(list)
-        index_pd = collections.defaultdict(list)
-        knn_gt_conf_all = collections.defaultdict(list)
-        for k in range(max_prediction_depth):
-            knn_labels, knn_conf_gt_all, indices_all = get_knn_prds_k_layer(model, evaluate_loader_train, supportloader,
-                                                                            k, train_split=args.get_train_pd)
-            for idx, knn_l, knn_conf_gt in zip(indices_all, knn_labels, knn_conf_gt_all):
-                index_knn_y[int(idx)].append(knn_l.item())
-                knn_gt_conf_all[int(idx)].append(knn_conf_gt.item())
-        for idx, knn_ls in index_knn_y.items():
-            index_pd[idx].append(_get_prediction_depth(knn_ls))
-
-        print(len(index_pd), len(index_knn_y), len(knn_gt_conf_all))
-        with open(os.path.join(args.result_dir, 'ms{}train_seed{}_f{}_trainpd.pkl'.format(args.arch, random_seed, flip)), 'w') as f:
-            json.dump(index_pd, f)
+        indices, knn_labels, knn_conf_gt, pds, sweep = get_pd_split(model, evaluate_loader_train, supportloader,
+                                                                    train_split=args.get_train_pd, split='train')
+        print(len(pds), knn_labels.shape, knn_conf_gt.shape)
+        if _rank() == 0:
+            _save_pd(_pd_result_path('train', random_seed, flip), indices, knn_labels, knn_conf_gt, pds, sweep)
 
     if args.get_val_pd:
-        index_knn_y = collections.defaultdict(list)
-        index_pd = collections.defaultdict(list)
-        knn_gt_conf_all = collections.defaultdict(list)
-        for k in range(max_prediction_depth):
-            knn_labels, knn_conf_gt_all, indices_all = get_knn_prds_k_layer(model, evaluate_loader_test, supportloader,
-                                                                            k, train_split=not(args.get_val_pd))
-            for idx, knn_l, knn_conf_gt in zip(indices_all, knn_labels, knn_conf_gt_all):
-                index_knn_y[int(idx)].append(knn_l.item())
-                knn_gt_conf_all[int(idx)].append(knn_conf_gt.item())
-        for idx, knn_ls in index_knn_y.items():
-            index_pd[idx].append(_get_prediction_depth(knn_ls))
-
-        print(len(index_pd), len(index_knn_y), len(knn_gt_conf_all))
-        with open(os.path.join(args.result_dir, 'ms{}_seed{}_f{}_test_pd.pkl'.format(args.arch, random_seed, flip)), 'w') as f:
-            json.dump(index_pd, f)
+        indices, knn_labels, knn_conf_gt, pds, sweep = get_pd_split(model, evaluate_loader_test, supportloader,
+                                                                    train_split=not(args.get_val_pd), split='val')
+        print(len(pds), knn_labels.shape, knn_conf_gt.shape)
+        if _rank() == 0:
+            _save_pd(_pd_result_path('val', random_seed, flip), indices, knn_labels, knn_conf_gt, pds, sweep)
 
+def run_seed(seed, flip=''):
+    """
+    train one model and compute its prediction depth, a self-contained job for run_seeds
+    :param seed: random seed of the model and of the train / val split
+    :param flip: '' or 'flip', 'flip' swaps the train split and the val split
+    """
+    print("------------------seed {} {}------------------".format(seed, flip))
+    if args.threads_per_worker:
+        torch.set_num_threads(args.threads_per_worker)
+    set_seed(seed)
+    train_indices, val_indices = train_test_split(np.arange(args.num_samples), train_size=args.train_ratio,
+                                               test_size=(1 - args.train_ratio))     # split the data
+    if flip:
+        train_indices, val_indices = val_indices, train_indices
+    trace_prefix = _start_trace('seed{}_f{}'.format(seed, flip), seed=seed, flip=flip)
+    try:
+        with torch_profile(trace_prefix + '_torch_trace.json' if trace_prefix and args.torch_profile else None), \
+                stage('run_seed'):
+            main(train_indices, val_indices, random_seed=seed, flip=flip)
+    finally:
+        set_tracer(Tracer())  # writes the Chrome trace, also of a failed job
 
-if __name__ == '__main__':
-    seeds = [9203, 9304, 9837, 9612, 3456, 5210]
-    for seed in seeds:
-        print("------------------{}-th seed {} out of {} many seeds------------------".format(seed, seeds.index(seed), len(seeds)))
+
+def _start_trace(name, **context):
+    """
+    trace the stages of a run into args.trace_dir, see instrument.Tracer
+    :param name: name of the run, part of the trace file names
+    :param context: fields added to every record
+    :return: path prefix of the trace files, None without args.trace_dir
+    """
+    if not args.trace_dir:
+        return None
+    os.makedirs(args.trace_dir, exist_ok=True)
+    trace_prefix = os.path.join(args.trace_dir, 'ms{}_{}{}'.format(
+        args.arch, name, '_rank{}'.format(_rank()) if _world_size() > 1 else ''))
+    set_tracer(Tracer(trace_prefix + '_stages.jsonl', trace_prefix + '_trace.json', device=device, arch=args.arch,
+                      rank=_rank(), **context))
+    return trace_prefix
+
+
+def run_ensemble(jobs):
+    """
+    train the models of several (seed, flip) jobs together as one ModelEnsemble and compute their prediction depths
+    with batched feature extraction, the counterpart of run_seed for --ensemble_size. Every member keeps the split,
+    the initialization, the data order and the augmentation of its own seed.
+    """
+    print("------------------seeds {}------------------".format(jobs))
+    if not args.tensor_data:
+        raise ValueError('--ensemble_size needs --tensor_data')
+    if args.threads_per_worker:
+        torch.set_num_threads(args.threads_per_worker)
+    trainset, testset = _get_datasets()
+    splits, models = [], []
+    for seed, flip in jobs:
         set_seed(seed)
         train_indices, val_indices = train_test_split(np.arange(args.num_samples), train_size=args.train_ratio,
-                                                   test_size=(1 - args.train_ratio))     # split the data
-        main(train_indices, val_indices, random_seed=seed, flip='')
-        # main(val_indices, train_indices, random_seed=seed, flip='flip')
+                                                      test_size=(1 - args.train_ratio))
+        splits.append((Subset(trainset, val_indices), Subset(trainset, train_indices)) if flip else
+                      (Subset(trainset, train_indices), Subset(trainset, val_indices)))
+        models.append(get_model(args.arch, args.num_classes).to(device))
+    trace_prefix = _start_trace('seeds{}'.format('-'.join('{}{}'.format(seed, flip) for seed, flip in jobs)),
+                                seeds=[seed for seed, _ in jobs], flips=[flip for _, flip in jobs])
+    try:
+        with torch_profile(trace_prefix + '_torch_trace.json' if trace_prefix and args.torch_profile else None), \
+                stage('run_ensemble', members=len(jobs)):
+            _run_ensemble(jobs, splits, models, testset)
+    finally:
+        set_tracer(Tracer())
+
+
+def _run_ensemble(jobs, splits, models, testset):
+    """
+    see run_ensemble
+    :param splits: (train split, val split) of every member
+    :param models: the initialized model of every member
+    """
+    to_train = []
+    for i, ((seed, flip), (train_split, _)) in enumerate(zip(jobs, splits)):
+        ckpt_path = _ckpt_cache_path(_train_config(train_split.indices, seed, flip, ensemble=True))
+        if args.resume:
+            models[i].load_state_dict(torch.load(os.path.join(args.result_dir, 'ms{}_{}sgd{}_{}.pt'.format(args.arch, args.data, seed, flip)),
+                                                 map_location=device))
+        elif not args.pd_every and ckpt_path is not None and os.path.exists(ckpt_path):  # see main
+            print('loading cached model', ckpt_path)
+            models[i].load_state_dict(torch.load(ckpt_path, map_location=device))
+        else:
+            to_train.append(i)
+    if to_train:
+        ensemble = ModelEnsemble([models[i] for i in to_train])
+        optimizer = torch.optim.SGD(ensemble.parameters(), lr=lr_init, momentum=momentum)
+        # every member shuffles and augments with the generator of its own seed
+        trainloaders = [TensorLoader(splits[i][0], 128, shuffle=True, augment=True,
+                                     generator=torch.Generator().manual_seed(jobs[i][0])) for i in to_train]
+        if len({len(trainloader) for trainloader in trainloaders}) != 1:
+            raise ValueError('the splits of the members of an ensemble must have the same size')
+        testloader = TensorLoader(testset, 1000)
+        pd_probes = [PDProbe(splits[i][0].dataset, splits[i][0].indices, splits[i][1].indices, *jobs[i])
+                     for i in to_train] if args.pd_every else None
+        with stage('train', epochs=args.num_epochs, members=len(to_train)):
+            trained = ensemble_trainer(trainloaders, testloader, ensemble, optimizer, args.num_epochs,
+                                       nn.CrossEntropyLoss(), [jobs[i] for i in to_train], pd_probes)
+        for i, model in zip(to_train, trained):
+            config = _train_config(splits[i][0].indices, *jobs[i], ensemble=True)
+            ckpt_path = _ckpt_cache_path(config)
+            if ckpt_path is not None:
+                _cache_model(model, config, ckpt_path)
+
+    supportloaders = [TensorLoader(train_split, args.bank_batch_size) for train_split, _ in splits]
+    exported = []
+    for (seed, _), model, supportloader in zip(jobs, models, supportloaders):
+        # BN has to use its running statistics during PD, see main
+        model.eval()
+        if not args.no_inference_export:
+            model = export_for_inference(model)
+        _set_tap_reducers(model, supportloader, seed)
+        exported.append(model)
+    ensemble = ModelEnsemble(exported)
+    support = _get_feature_banks_ensemble(ensemble, supportloaders, 'support')
+    pd_splits = [('train', args.get_train_pd, [TensorLoader(train_split, 200) for train_split, _ in splits], True),
+                 ('val', args.get_val_pd, [TensorLoader(val_split, 200) for _, val_split in splits], False)]
+    for split, enabled, evaloaders, train_split in pd_splits:
+        if not enabled:
+            continue
+        results = get_pd_split_ensemble(ensemble, evaloaders, support, train_split=train_split, split=split)
+        for (seed, flip), (indices, knn_labels, knn_conf_gt, pds, sweep) in zip(jobs, results):
+            print(seed, flip, len(pds), knn_labels.shape, knn_conf_gt.shape)
+            _save_pd(_pd_result_path(split, seed, flip), indices, knn_labels, knn_conf_gt, pds, sweep)
+
+
+def _result_done(path):
+    """
+    whether the result at path (without extension) exists and was computed with the current _pd_config
+    """
+    ext = '.npz' if args.result_format == 'npz' else '.pkl'
+    if not (os.path.exists(path + ext) and os.path.exists(_pd_config_path(path))):
+        return False
+    with open(_pd_config_path(path)) as f:
+        return json.load(f) == json.loads(json.dumps(_pd_config()))
+
+
+def _job_done(seed, flip):
+    """
+    whether all results of a job already exist, computed with the current settings (see _pd_config). Results of other
+    settings (or without a saved config) are computed again and overwritten.
+    """
+    splits = [split for split, enabled in (('train', args.get_train_pd), ('val', args.get_val_pd)) if enabled]
+    return all(_result_done(_pd_result_path(split, seed, flip)) for split in splits)
+
+
+def run_seeds(jobs):
+    """
+    run (seed, flip) jobs in args.seed_workers processes, skipping jobs whose results exist with the current settings
+    and retrying failed jobs up to args.max_retries times. Since finished jobs are skipped, re-running the script resumes an interrupted run.
+    :return: the jobs that still failed after all retries
+    """
+    pending = [job for job in jobs if not _job_done(*job)]
+    print('{} of {} jobs already done'.format(len(jobs) - len(pending), len(jobs)))
+    attempts = collections.Counter()
+    failed = []
+    if _world_size() > 1:
+        # every process has to run the same jobs in the same order, as decided by rank 0 (the one writing results).
+        # No retries: a process failing inside a collective cannot be recovered, torchrun restarts the whole group.
+        decided = [pending]
+        dist.broadcast_object_list(decided, src=0)
+        for job in decided[0]:
+            run_seed(*job)
+        return failed
+    if args.ensemble_size > 1:
+        # members of an ensemble need splits of the same size, a flipped split only has the size of the unflipped one
+        # for --train_ratio 0.5
+        groups = []
+        for flip in sorted({flip for _, flip in pending}):
+            flip_jobs = [job for job in pending if job[1] == flip]
+            groups += [flip_jobs[i:i + args.ensemble_size] for i in range(0, len(flip_jobs), args.ensemble_size)]
+        for group in groups:
+            while True:
+                try:
+                    run_ensemble(group)
+                    break
+                except Exception as e:
+                    attempts[tuple(group)] += 1
+                    print('jobs {} failed ({!r}), attempt {}'.format(group, e, attempts[tuple(group)]))
+                    if attempts[tuple(group)] > args.max_retries:
+                        failed += group
+                        break
+        return failed
+    if args.seed_workers <= 1:
+        for job in pending:
+            while True:
+                try:
+                    run_seed(*job)
+                    break
+                except Exception as e:
+                    attempts[job] += 1
+                    print('job {} failed ({!r}), attempt {}'.format(job, e, attempts[job]))
+                    if attempts[job] > args.max_retries:
+                        failed.append(job)
+                        break
+        return failed
+
+    # spawn, as forking a process that already used torch's thread pools can deadlock
+    with ProcessPoolExecutor(max_workers=args.seed_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(run_seed, *job): job for job in pending}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    future.result()
+                    print('job {} finished'.format(job))
+                except Exception as e:
+                    attempts[job] += 1
+                    print('job {} failed ({!r}), attempt {}'.format(job, e, attempts[job]))
+                    if attempts[job] > args.max_retries or isinstance(e, BrokenProcessPool):
+                        failed.append(job)
+                    else:
+                        futures[pool.submit(run_seed, *job)] = job
+    return failed
+
+
+if __name__ == '__main__':
+    _check_knn_args()  # before any training or extraction
+    if args.pd_every and args.resume:
+        raise ValueError('--pd_every computes PD during training, a model loaded with --resume is not trained')
+    if len(_knn_configs()) > 1 and args.result_format != 'npz':
+        raise ValueError('a knn sweep is saved in npz results, use --result_format npz')
+    if args.ensemble_size > 1 and (args.seed_workers > 1 or args.shard_pd):
+        raise ValueError('--ensemble_size runs in a single process, use --seed_workers 1 and no --shard_pd')
+    if args.shard_pd:
+        if args.seed_workers > 1:
+            raise ValueError('--shard_pd runs one seed at a time, use --seed_workers 1')
+        dist.init_process_group('gloo')  # rank, world size and master address come from torchrun
+    seeds = [9203, 9304, 9837, 9612, 3456, 5210]
+    jobs = [(seed, flip) for seed in seeds for flip in (('', 'flip') if args.run_flip else ('',))]
+    failed_jobs = run_seeds(jobs)
+    if failed_jobs:
+        print('failed jobs, re-run to retry them:', failed_jobs)
+    if args.shard_pd:
+        dist.destroy_process_group()
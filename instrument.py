@@ -0,0 +1,221 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import torch
+
+
+def _is_cuda(device):
+    return torch.device(device).type == 'cuda'
+
+
+def _proc_status(field):
+    """
+    :return: a memory field of /proc/self/status in bytes, None if it cannot be read
+    """
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith(field + ':'))
+    except (OSError, StopIteration):
+        return None
+
+
+def reset_peak_memory(device='cpu'):
+    """
+    reset the peak memory counter of device: the peak allocation of a cuda device, the peak resident set size of the
+    process otherwise (linux only)
+    """
+    if _is_cuda(device):
+        torch.cuda.reset_peak_memory_stats(device)
+    elif os.path.exists('/proc/self/clear_refs'):
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')  # resets VmHWM to the current VmRSS
+        except OSError:
+            pass
+
+
+def peak_memory(device='cpu'):
+    """
+    :return: peak memory of device in bytes since reset_peak_memory (or the process start), None if it cannot be
+            measured
+    """
+    if _is_cuda(device):
+        return torch.cuda.max_memory_allocated(device)
+    return _proc_status('VmHWM')
+
+
+def current_memory(device='cpu'):
+    """
+    :return: memory of device in use in bytes, None if it cannot be measured
+    """
+    if _is_cuda(device):
+        return torch.cuda.memory_allocated(device)
+    return _proc_status('VmRSS')
+
+
+class Tracer(object):
+    """
+    Records the stages of a run as one json object per line (wall time, samples per second and peak memory of every
+    stage, plus the fields the stage adds) and optionally as a Chrome trace (chrome://tracing or ui.perfetto.dev),
+    one row per thread so overlapping pipeline stages show up side by side. Stages are also torch.profiler ranges.
+    The peak memory of a stage is the peak while it runs: the counter is reset at the entry of every stage and its value
+    is folded into all open stages before, so nested stages and the stages around them both get their own peak.
+    Stages overlapping in other threads share the peak of their overlap.
+    Without a log path and a trace path nothing is written, the stages then only cost a few clock reads.
+    """
+    def __init__(self, log_path=None, chrome_trace_path=None, device='cpu', **context):
+        """
+        :param log_path: path of the json lines log, appended to
+        :param chrome_trace_path: path of the Chrome trace, written by close
+        :param device: device of the run, whose memory is recorded (see peak_memory)
+        :param context: fields added to every record, e.g. the seed of the run
+        """
+        self.log_path = log_path
+        self.chrome_trace_path = chrome_trace_path
+        self.device = device
+        self.context = context
+        self._events = []
+        self._open_stages = []  # memory of the open stages, [memory at entry, peak so far]
+        self._lock = threading.Lock()
+        self._log = open(log_path, 'a') if log_path else None
+        self._t0 = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return self._log is not None or self.chrome_trace_path is not None
+
+    def _write(self, record, chrome_event):
+        with self._lock:
+            if self._log is not None:
+                self._log.write(json.dumps(dict(self.context, **record)) + '\n')
+                self._log.flush()  # a crashed run keeps the stages up to the crash
+            if self.chrome_trace_path is not None:
+                chrome_event.update(pid=os.getpid(), tid=threading.get_ident(),
+                                    args={key: value for key, value in record.items() if key != 'stage'})
+                self._events.append(chrome_event)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        time a stage of the run
+        :param name: name of the stage
+        :param fields: fields of the record, e.g. the layer. A 'samples' field adds samples_per_sec to the record
+        :return: context yielding the record, fields known only at the end of the stage can be added to it
+        """
+        record = dict(fields)
+        memory = self._enter_stage() if self.enabled else None
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield record
+        except BaseException as e:
+            record['error'] = repr(e)  # the stage a run failed in is in the log as well
+            raise
+        finally:
+            if self.enabled:
+                self._record_stage(name, record, start, memory)
+
+    def _fold_peak(self):
+        """
+        fold the peak since the last reset into the open stages, called with the lock held
+        """
+        peak = peak_memory(self.device)
+        if peak is not None:
+            for memory in self._open_stages:
+                memory[1] = max(memory[1], peak)
+
+    def _enter_stage(self):
+        with self._lock:
+            self._fold_peak()
+            reset_peak_memory(self.device)
+            current = current_memory(self.device)
+            memory = [current, current if current is not None else 0]
+            self._open_stages.append(memory)
+        return memory
+
+    def _exit_stage(self, memory):
+        with self._lock:
+            self._fold_peak()
+            self._open_stages = [open_memory for open_memory in self._open_stages if open_memory is not memory]
+
+    def _record_stage(self, name, record, start, memory):
+        seconds = time.perf_counter() - start
+        record.update(stage=name, start=start - self._t0, seconds=seconds)
+        if record.get('samples') is not None:
+            record['samples_per_sec'] = record['samples'] / max(seconds, 1e-12)
+        record.update(peak_memory_bytes=None, peak_memory_increase_bytes=None)
+        if memory is not None:
+            self._exit_stage(memory)
+            if memory[0] is not None:
+                # peak while the stage ran, and how far it rose above the memory in use at its entry
+                record.update(peak_memory_bytes=memory[1], peak_memory_increase_bytes=memory[1] - memory[0])
+        self._write(record, {'name': name, 'cat': 'stage', 'ph': 'X', 'ts': (start - self._t0) * 1e6,
+                             'dur': seconds * 1e6})
+
+    def event(self, name, **fields):
+        """
+        record a measurement that is not a stage, e.g. the size of a feature bank
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter() - self._t0
+        record = dict(fields, stage=name, start=now)
+        self._write(record, {'name': name, 'cat': 'event', 'ph': 'i', 's': 't', 'ts': now * 1e6})
+
+    def close(self):
+        """
+        close the log and write the Chrome trace
+        """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self.chrome_trace_path is not None:
+            with open(self.chrome_trace_path + '.tmp', 'w') as f:
+                json.dump({'traceEvents': self._events, 'displayTimeUnit': 'ms'}, f)
+            os.replace(self.chrome_trace_path + '.tmp', self.chrome_trace_path)
+            self._events = []
+
+
+_tracer = Tracer()
+
+
+def set_tracer(tracer):
+    """
+    make tracer the one of stage and event, the previous one is closed
+    """
+    global _tracer
+    _tracer.close()
+    _tracer = tracer
+
+
+def stage(name, **fields):
+    """
+    see Tracer.stage, recorded by the tracer of set_tracer
+    """
+    return _tracer.stage(name, **fields)
+
+
+def event(name, **fields):
+    """
+    see Tracer.event, recorded by the tracer of set_tracer
+    """
+    _tracer.event(name, **fields)
+
+
+@contextlib.contextmanager
+def torch_profile(path):
+    """
+    run the context under torch.profiler and export its Chrome trace (operator level, with the stages as ranges)
+    :param path: path of the trace, None to run without the profiler
+    """
+    if path is None:
+        yield
+        return
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+        yield
+    prof.export_chrome_trace(path)
@@ -1,6 +1,85 @@
+import copy
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.func import stack_module_state, functional_call, vmap
+import torchvision
+from torchvision.models import vgg16
+
+
+class _StopForward(Exception):
+    pass
+
+
+class TapRegistry(object):
+    """
+    Probes layers of any nn.Module (e.g. torchvision models) with forward hooks. Every tapped module has to run exactly
+    once per forward pass and the taps have to be in execution order, a tap that has not run when the forward pass is
+    stopped (right after the deepest requested tap) raises a ValueError.
+    """
+    def __init__(self, model, layers=None):
+        """
+        :param model: the model, model(x) runs its forward pass
+        :param layers: list of (module name, transform) in forward order, transform maps the module output to the
+                    tapped fm (None: the output itself). None: model.tap_layers() if the model has it, else
+                    default_tap_layers(model)
+        """
+        if layers is None:
+            layers = model.tap_layers() if hasattr(model, 'tap_layers') else default_tap_layers(model)
+        modules = dict(model.named_modules())
+        self.model = model
+        self.names = [name for name, _ in layers]
+        self.layers = [(modules[name], transform) for name, transform in layers]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __call__(self, x, taps=None):
+        """
+        :param x: input batch
+        :param taps: indices of the taps to return (None: all of them)
+        :return: list of B x F fms (reduced by the tap reducers of the model, see reduce_tap) in the order of taps
+        """
+        taps = list(range(len(self))) if taps is None else list(taps)
+        wanted, deepest = set(taps), max(taps)
+        fms = {}
+
+        def make_hook(k, transform):
+            def hook(module, inputs, output):
+                if k in wanted:
+                    fms[k] = reduce_tap(self.model, k, transform(output) if transform is not None else output)
+                if k == deepest:
+                    raise _StopForward  # nothing after the deepest tap is needed
+            return hook
+
+        handles = [module.register_forward_hook(make_hook(k, transform))
+                   for k, (module, transform) in enumerate(self.layers[:deepest + 1])]
+        try:
+            self.model(x)
+        except _StopForward:
+            pass
+        finally:
+            for handle in handles:
+                handle.remove()
+        missing = [k for k in taps if k not in fms]
+        if missing:
+            raise ValueError('taps {} did not run in the forward pass before the deepest requested tap {} ({}): '
+                             'every tapped module has to run in the forward pass, and the taps have to be listed in '
+                             'execution order'.format(', '.join('{} ({})'.format(k, self.names[k]) for k in missing), deepest,
+                                            self.names[deepest]))
+        return [fms[k] for k in taps]
+
+
+def default_tap_layers(model):
+    """
+    taps of a model without tap_layers(): the output of every Conv2d and Linear in registration order, the softmax of
+    the last one
+    """
+    names = [name for name, module in model.named_modules() if isinstance(module, (nn.Conv2d, nn.Linear))]
+    # clone, the conv may be followed by an in-place activation
+    return [(name, torch.clone) for name in names[:-1]] + [(names[-1], lambda out: torch.softmax(out, 1))]
+
 
 class VGGPD(nn.Module):
     """
@@ -28,22 +107,25 @@ class VGGPD(nn.Module):
         :param k: output fms from the kth conv2d or the last layer
         :return:
         """
-        n_layer = 0
-        _fm = None
-        for m in self.encoder.children(): #  x goes through all the layers
-            x = m(x)
-            if not train:
-                if isinstance(m, nn.Conv2d):
-                    if n_layer == k: # returns here if we are getting the feature map from this layer
-                        return None, x.view(x.shape[0], -1) # B x (C x F x F)
-                    n_layer += 1
-        logits = self.classifier(x)
         if not train:
-            if k == n_layer:
-                _fm = torch.softmax(logits, 1)
-                return None, _fm.view(_fm.shape[0], -1)  # B x (C x F x F)
-        else:
-            return logits
+            return None, self.forward_taps(x, taps=[k])[0]  # B x (C x F x F)
+        return self.classifier(self.encoder(x))
+
+    def tap_layers(self):
+        """
+        every conv2d (cloned, the following in-place ReLU would overwrite it) and the softmax of the last layer
+        """
+        convs = ['encoder.{}'.format(name) for name, m in self.encoder.named_children() if isinstance(m, nn.Conv2d)]
+        return [(name, torch.clone) for name in convs] + [('classifier', lambda logits: torch.softmax(logits, 1))]
+
+    def forward_taps(self, x, taps=None):
+        """
+        output fms from the conv2ds and the last layer in a single forward pass, stopped after the deepest tap
+        :param x:
+        :param taps: indices of the taps to return (None: all of them)
+        :return: list of B x (C x F x F) fms, index k matches the k of forward()
+        """
+        return TapRegistry(self, self.tap_layers())(x, taps)
 
 
 class MLP7(nn.Module):
@@ -60,91 +142,409 @@ class MLP7(nn.Module):
         self.d7 = nn.Linear(2048, num_classes)
 
     def forward(self, x, k=0, train=True):
-        representations = []
-        f1 = self.d1(self.fl(x))
-        representations.append(f1) # B x 1 x F
-        f2 = self.d2(torch.relu_(f1))
-        representations.append(f2)
-        f3 = self.d3(torch.relu_(f2))
-        representations.append(f3)
-        f4 = self.d4(torch.relu_(f3))
-        representations.append(f4)
-        f5 = self.d5(torch.relu_(f4))
-        representations.append(f5)
-        f6 = self.d6(torch.relu_(f5))
-        representations.append(f6)
-        logits = self.d7(torch.relu_(f6))
-
-        # the last representation is added after softmax
-        f7 = torch.softmax(logits, dim=1)
-        representations.append(f7)
-        if train:
-            return logits
-        else:
-            return None, representations[k]
+        if not train:
+            return None, self.forward_taps(x, taps=[k])[0]
+        f = self.d1(self.fl(x))
+        for d in (self.d2, self.d3, self.d4, self.d5, self.d6, self.d7):
+            f = d(torch.relu(f))
+        return f
+
+    def tap_layers(self):
+        """
+        the hidden representations after relu and the softmax of the last layer
+        """
+        return [('d{}'.format(i), torch.relu) for i in range(1, 7)] + [('d7', lambda logits: torch.softmax(logits, 1))]
+
+    def forward_taps(self, x, taps=None):
+        """
+        output the representations of every layer in a single forward pass, stopped after the deepest tap
+        :param x:
+        :param taps: indices of the taps to return (None: all of them)
+        :return: list of B x F representations, index k matches the k of forward()
+        """
+        return TapRegistry(self, self.tap_layers())(x, taps)
+
+
+class FeatureBank(object):
+    """
+    Feature bank of the support set, caches what the distance kernel needs once per layer
+    """
+    cast_bytes = 64 * 2 ** 20  # float copy of a lower precision bank per distance GEMM
+
+    def __init__(self, features, labels, dist='l2', transposed=False):
+        """
+        :param features: features of the support set (dim = [K, F]
+        :param labels: labels of the support set (dim = [K]
+        :param dist: distance metric the bank is queried with, 'l2' or 'cos'
+        :param transposed: keep the features as a contiguous [F, K] matrix instead of [K, F]
+        """
+        if dist not in ('l2', 'cos'):
+            raise ValueError('unknown distance metric {}'.format(dist))
+        self.dist = dist
+        self.labels = labels
+        # the features keep their storage dtype (e.g. fp16 / bf16), only chunks of at most cast_bytes are cast to float
+        # at query time
+        self.sq_norms = torch.cat([chunk.float().pow(2).sum(1) for chunk in features.split(4096)])  # K
+        self.transposed = transposed
+        self.features = features.t().contiguous() if transposed else features
+        self.cast_chunk = len(self) if features.dtype == torch.float32 else \
+            max(self.cast_bytes // (4 * max(features.shape[1], 1)), 1)  # pts per cast chunk
+
+    def __len__(self):
+        return self.sq_norms.shape[0]
+
+    def prepare(self, feature):
+        """
+        :return: the feature vectors (dim = [B, F] in the form pairwise_distances expects for this bank
+        """
+        feature = feature.float()
+        if self.dist == 'cos':
+            feature = F.normalize(feature, dim=1)
+        return feature
+
+    def tile(self, start, end):
+        """
+        :return: the features (dim = [F, end - start] and squared norms (dim = [end - start] of pts start ... end - 1
+        """
+        features = self.features[:, start:end] if self.transposed else self.features[start:end].t()
+        return features.float(), self.sq_norms[start:end]
+
+    def distances(self, feature, start, end):
+        """
+        distances between prepared feature vectors and the pts start ... end - 1, see pairwise_distances. A bank in a
+        lower precision is cast to float cast_chunk pts at a time, never as a whole tile
+        :param feature: feature vectors (dim = [B, F], from prepare
+        :return: distances (dim = [B, end - start]
+        """
+        end = min(end, len(self))
+        if end - start <= self.cast_chunk:
+            return pairwise_distances(feature, *self.tile(start, end), dist=self.dist)
+        distances = torch.empty(feature.shape[0], end - start, device=feature.device)
+        for chunk_start in range(start, end, self.cast_chunk):
+            chunk_end = min(chunk_start + self.cast_chunk, end)
+            distances[:, chunk_start - start:chunk_end - start] = pairwise_distances(
+                feature, *self.tile(chunk_start, chunk_end), dist=self.dist)
+        return distances
+
+    def search(self, feature, knn_k, tile_size=None, self_indices=None):
+        """
+        exact k nearest neighbors, see knn_topk
+        """
+        return knn_topk(feature, self, knn_k, tile_size=tile_size, self_indices=self_indices)
+
+
+class IVFIndex(object):
+    """
+    Inverted file index over the feature bank of the support set: the pts are clustered with k-means and a query is
+    only compared to the pts of the n_probe clusters with the nearest centroids. Approximate, a neighbor in a cluster
+    that is not probed is missed. Has the search interface of FeatureBank, the bank is kept sorted by cluster.
+    """
+    def __init__(self, features, labels, dist='l2', transposed=False, n_lists=None, n_probe=8, n_iter=10,
+                 n_train=None, seed=0):
+        """
+        :param features: features of the support set (dim = [K, F]
+        :param labels: labels of the support set (dim = [K]
+        :param dist: distance metric the bank is queried with, 'l2' or 'cos'
+        :param transposed: keep the features as a contiguous [F, K] matrix instead of [K, F]
+        :param n_lists: number of clusters (None: sqrt(K))
+        :param n_probe: number of clusters searched per query
+        :param n_iter: number of k-means iterations
+        :param n_train: number of pts the k-means is fitted on (None: 64 per cluster)
+        :param seed: seed of the k-means initialization and of the training sample
+        """
+        K = features.shape[0]
+        self.n_lists = min(n_lists or max(int(K ** 0.5), 1), K)
+        self.n_probe = min(n_probe, self.n_lists)
+        generator = torch.Generator().manual_seed(seed)
+
+        def prepare(x):  # as FeatureBank.prepare, k-means runs in float on normalized pts for 'cos'
+            return F.normalize(x.float(), dim=1) if dist == 'cos' else x.float()
+        train = features[torch.randperm(K, generator=generator)[:n_train or 64 * self.n_lists].to(features.device)]
+        train = prepare(train)
+        self.centroids = train[:self.n_lists].clone()
+        for _ in range(n_iter):
+            assign = self._nearest_centroids(train, 1)[:, 0]
+            counts = torch.bincount(assign, minlength=self.n_lists)
+            sums = torch.zeros_like(self.centroids).index_add_(0, assign, train)
+            nonempty = counts > 0  # empty clusters keep their centroid
+            self.centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        assign = torch.cat([self._nearest_centroids(prepare(chunk), 1)[:, 0] for chunk in features.split(4096)])
+        self.order = torch.argsort(assign, stable=True)  # position in the sorted bank -> position in the support set
+        counts = torch.bincount(assign, minlength=self.n_lists)
+        self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+        self.bank = FeatureBank(features[self.order], labels[self.order], dist=dist, transposed=transposed)
+        self.labels = labels
+        self.dist = dist
+
+    def __len__(self):
+        return len(self.bank)
+
+    def _nearest_centroids(self, feature, n):
+        """
+        :return: the n nearest centroids of each prepared feature vector (dim = [B, n]
+        """
+        distances = pairwise_distances(feature, self.centroids.t(), self.centroids.pow(2).sum(1), dist='l2')
+        return distances.topk(n, dim=1, largest=False)[1]
+
+    def search(self, feature, knn_k, tile_size=None, self_indices=None):
+        """
+        approximate k nearest neighbors, pts of the probed clusters only. Queries with less than knn_k candidates get
+        inf distances (no vote) for the missing neighbors.
+        :param feature: feature vector of the current evaluating batch (dim = [B, F]
+        :param knn_k: number of nearest neighbors
+        :param tile_size: unused, a cluster is searched at once
+        :param self_indices: position of each feature vector in the support set (dim = [B], see knn_topk
+        :return: distances and indices (in the support set) of the nearest neighbors, sorted from the nearest
+                (dim = [B, knn_k]
+        """
+        feature = self.bank.prepare(feature)
+        B = feature.shape[0]
+        probe = self._nearest_centroids(feature, self.n_probe)  # B x n_probe
+        top_distances = torch.full((B, knn_k), float('inf'), device=feature.device)
+        top_indices = torch.zeros((B, knn_k), dtype=torch.long, device=feature.device)
+        if self_indices is not None:
+            sorted_position = torch.empty_like(self.order)
+            sorted_position[self.order] = torch.arange(len(self.order), device=self.order.device)
+            self_indices = sorted_position[self_indices.to(self.order.device)].to(feature.device)
+        for c in probe.unique().tolist():
+            start, end = self.offsets[c], self.offsets[c + 1]
+            if start == end:
+                continue
+            rows = (probe == c).any(1).nonzero()[:, 0]  # queries probing this cluster
+            distances = self.bank.distances(feature[rows], start, end)
+            if self_indices is not None:
+                columns = torch.arange(start, end, device=distances.device)
+                distances.masked_fill_(self_indices[rows, None] == columns[None, :], float('inf'))
+            top_distances[rows], top_indices[rows] = _merge_topk(top_distances[rows], top_indices[rows], distances,
+                                                                 start, knn_k)
+        return top_distances, self.order.to(top_indices.device)[top_indices]
+
+
+def pairwise_distances(feature, bank_features, bank_sq_norms, dist='l2'):
+    """
+    distances between a batch of features and a tile of the feature bank through a single GEMM
+    :param feature: feature vectors (dim = [B, F], already normalized for 'cos'
+    :param bank_features: tile of the feature bank (dim = [F, K]
+    :param bank_sq_norms: squared norms of the tile (dim = [K]
+    :param dist: distance metric, 'l2' or 'cos'
+    :return: distances (dim = [B, K]
+    """
+    if dist == 'l2':
+        # |x - y|^2 = |x|^2 + |y|^2 - 2 x.y, clamped since rounding can make it slightly negative
+        sq_dist = torch.addmm(feature.pow(2).sum(1, keepdim=True) + bank_sq_norms[None, :], feature, bank_features,
+                              alpha=-2)
+        return sq_dist.clamp_min_(0).sqrt_()
+    elif dist == 'cos':
+        # the bank is not normalized, its norms are divided out of the dot products instead
+        similarity = torch.mm(feature, bank_features).div_(bank_sq_norms.sqrt().clamp_min(1e-12)[None, :])
+        return similarity.neg_().add_(1).clamp_min_(0)
+    raise ValueError('unknown distance metric {}'.format(dist))
+
+
+def _merge_topk(top_distances, top_indices, distances, start, knn_k):
+    """
+    merge the running top k of each row with the top k of a new block of distances whose columns are the feature bank
+    pts start, start + 1, ...
+    :return: the merged top k distances and indices, sorted from the nearest
+    """
+    distances, indices = distances.topk(min(knn_k, distances.shape[1]), dim=1, largest=False)
+    indices += start
+    if top_distances is not None:
+        distances = torch.cat([top_distances, distances], dim=1)
+        distances, merged = distances.topk(min(knn_k, distances.shape[1]), dim=1, largest=False)
+        indices = torch.cat([top_indices, indices], dim=1).gather(dim=1, index=merged)
+    return distances, indices
+
 
-def knn_predict(feature, feature_bank, feature_labels, classes, knn_k, knn_t, rm_top1=True, dist='l2'):
+def knn_topk(feature, feature_bank, knn_k, tile_size=None, self_indices=None):
+    """
+    k nearest neighbors of each feature vector, searched tile by tile over the feature bank so that only a
+    B x tile_size block of distances exists at a time
+    :param feature: feature vector of the current evaluating batch (dim = [B, F]
+    :param feature_bank: FeatureBank of the support set
+    :param knn_k: number of nearest neighbors
+    :param tile_size: number of feature bank pts per tile (None: the whole feature bank in one tile)
+    :param self_indices: position of each feature vector in the feature bank (dim = [B], these pts are never returned
+                    as their own neighbors
+    :return: distances and indices of the nearest neighbors, sorted from the nearest (dim = [B, knn_k]
+    """
+    feature = feature_bank.prepare(feature)
+    K = len(feature_bank)
+    knn_k = min(knn_k, K if self_indices is None else K - 1)
+    tile_size = tile_size or K
+    top_distances, top_indices = None, None
+    for start in range(0, K, tile_size):
+        distances = feature_bank.distances(feature, start, start + tile_size)
+        if self_indices is not None:
+            columns = torch.arange(start, start + distances.shape[1], device=distances.device)
+            distances.masked_fill_(self_indices.to(distances.device)[:, None] == columns[None, :], float('inf'))
+        top_distances, top_indices = _merge_topk(top_distances, top_indices, distances, start, knn_k)
+    return top_distances, top_indices
+
+
+def knn_topk_self(feature_bank, knn_k, tile_size=None):
+    """
+    k nearest neighbors of every pt of the feature bank among the other pts of the feature bank. Distances are
+    symmetric, so every pair of tiles is computed once and used for the rows of both tiles.
+    :param feature_bank: FeatureBank of the support set
+    :param knn_k: number of nearest neighbors, not counting the pt itself
+    :param tile_size: number of feature bank pts per tile (None: the whole feature bank in one tile)
+    :return: distances and indices of the nearest neighbors, sorted from the nearest (dim = [K, knn_k]
+    """
+    K = len(feature_bank)
+    knn_k = min(knn_k, K - 1)
+    tile_size = min(tile_size or K, feature_bank.cast_chunk)  # the rows of a tile are cast to float as queries
+    starts = list(range(0, K, tile_size))
+    tops = [(None, None) for _ in starts]
+    for i, row_start in enumerate(starts):
+        bank_features, _ = feature_bank.tile(row_start, row_start + tile_size)
+        rows = feature_bank.prepare(bank_features.t())
+        for j in range(i, len(starts)):
+            col_start = starts[j]
+            distances = feature_bank.distances(rows, col_start, col_start + tile_size)
+            if i == j:
+                distances.fill_diagonal_(float('inf'))  # exclude self by index, not by rank
+            else:
+                tops[j] = _merge_topk(*tops[j], distances.t(), row_start, knn_k)
+            tops[i] = _merge_topk(*tops[i], distances, col_start, knn_k)
+    top_distances, top_indices = zip(*tops)
+    return torch.cat(top_distances, dim=0), torch.cat(top_indices, dim=0)
+
+
+knn_weightings = ('inverse', 'uniform', 'exp')
+
+
+def knn_vote(nearest_distances, nearest_labels, classes, knn_t, weighting='inverse'):
+    """
+    class scores from the weighted votes of the nearest neighbors
+    :param nearest_distances: distances of the nearest neighbors (dim = [B, knn_k], inf for missing neighbors
+    :param nearest_labels: labels of the nearest neighbors (dim = [B, knn_k]
+    :param classes: number of classes
+    :param knn_t: temperature
+    :param weighting: weight of a vote, 'inverse': 1 / distance (clamped to 1e-12), 'uniform': 1 (majority vote),
+                    'exp': exp(-distance / knn_t). The scores are only compared after normalization, so knn_t only has
+                    an effect with 'exp'
+    :return: prediction scores for each class (dim = [B, classes]
+    """
+    if weighting == 'inverse':
+        # a neighbor at distance 0 (a duplicate of the pt) gets a large finite weight instead of inf, which would turn
+        # the normalized scores into nan
+        weights = 1.0 / nearest_distances.clamp_min(1e-12)
+    elif weighting == 'uniform':
+        weights = torch.isfinite(nearest_distances).to(nearest_distances.dtype)
+    elif weighting == 'exp':
+        # shifted by the nearest distance of each row, which only rescales the row, so that large distances do not
+        # underflow to all zero weights
+        shift = nearest_distances.amin(dim=1, keepdim=True)
+        weights = torch.exp(-(nearest_distances - torch.where(torch.isfinite(shift), shift, 0)) / knn_t)
+    else:
+        raise NotImplementedError
+    knn_scores = torch.zeros(nearest_labels.shape[0], classes, device=nearest_labels.device)
+    knn_scores.scatter_add_(1, nearest_labels, weights.to(knn_scores.dtype))
+
+    # Apply temperature scaling
+    knn_scores /= knn_t
+
+    return knn_scores
+
+
+def knn_predict(feature, feature_bank, feature_labels, classes, knn_k, knn_t, rm_top1=True, dist='l2',
+                legacy_weights=False, tile_size=None, self_indices=None, weighting='inverse'):
     """
     knn prediction
     :param feature: feature vector of the current evaluating batch (dim = [B, F]
-    :param feature_bank: feature bank of the support set (dim = [F, K]
-    :param feature_labels: labels of the support set (dim = [K]
+    :param feature_bank: FeatureBank or IVFIndex of the support set, or the feature bank tensor (dim = [F, K]
+    :param feature_labels: labels of the support set (dim = [K], ignored unless feature_bank is a tensor
     :param classes: number of classes
     :param knn_k: number of nearest neighbors
     :param knn_t: temperature
     :param rm_top1: whether to remove the nearest pt of current evaluating pt in the train split (explain: this is because
                     the feature vector of the current evaluating pt may also be in the feature bank)
-    :param dist: distance metric
+    :param dist: distance metric, 'l2' or 'cos', ignored when feature_bank is a FeatureBank
+    :param legacy_weights: weight the votes with the distances to the first knn_k pts of the feature bank instead of the
+                    distances of the selected neighbors (only to reproduce results of earlier versions)
+    :param tile_size: number of feature bank pts whose distances are computed at once, see knn_topk
+    :param self_indices: position of each evaluating pt in the feature bank (dim = [B], excludes the pt itself from
+                    its neighbors by index, see knn_topk (use with rm_top1=False)
+    :param weighting: weight of a vote, see knn_vote
     :return: prediction scores for each class (dim = [B, classes]
     """
-    # compute cos similarity between each feature vector and feature bank ---> [B, N]
-    feature_bank = feature_bank.t()  # [F, K].t() -> [K, F]
+    if isinstance(feature_bank, torch.Tensor):
+        feature_bank = FeatureBank(feature_bank.t(), feature_labels, dist=dist)  # [F, K].t() -> [K, F]
     B, F = feature.shape  # dim of feature vector of the current evaluating pt
-    K, F = feature_bank.shape  # dim feature bank
+    K = len(feature_bank)  # number of pts in the feature bank
     """
     B: batch size (ie: 200)
     F: feature dimension (ie: 65536)
     K: number of pts in the feature bank (ie 5000)
     """
 
-    # print("------------------")
-    # print("feature label shape: ", feature_labels.shape)
-    # print("feature shape: ", feature.shape)
-    # print("feature bank shape: ", feature_bank.shape)
-    # print("B: ", B)
-    # print("F: ", F)
-    # print("K: ", K)
-    # print("------------------")
+    # Find the k nearest neighbors of the input feature.
+    nearest_distances, nearest_neighbors = feature_bank.search(feature, knn_k, tile_size=tile_size,
+                                                               self_indices=self_indices)
+    if legacy_weights:
+        nearest_distances = feature_bank.distances(feature_bank.prepare(feature), 0, knn_k)
 
-    if dist == 'l2':
-        knn_dist = 2
+    # If `rm_top1` is True, remove the nearest neighbor of the current evaluating point from the list of nearest neighbors.
+    if rm_top1:
+        nearest_neighbors = nearest_neighbors[:, 1:]
+        nearest_distances = nearest_distances[:, :-1] if legacy_weights else nearest_distances[:, 1:]
+    nearest_labels = feature_bank.labels[nearest_neighbors]  # B x knn_k
 
-    distances = torch.cdist(feature, feature_bank, p=knn_dist)
+    # Compute the weighted scores, by default using the inverse distances
+    return knn_vote(nearest_distances, nearest_labels, classes, knn_t, weighting)
 
-    # Find the k nearest neighbors of the input feature.
-    nearest_neighbors = distances.argsort(dim=1)[:, :knn_k]
 
-    # If `rm_top1` is True, remove the nearest neighbor of the current evaluating point from the list of nearest neighbors.
+def knn_predict_sweep(feature, feature_bank, classes, configs, rm_top1=True, tile_size=None, self_indices=None):
+    """
+    knn predictions of several knn configurations from a single neighbor search for the largest knn_k: the neighbors
+    of a smaller knn_k are the first ones of the sorted neighbor lists. A config gives the same scores as knn_predict.
+    :param feature: feature vector of the current evaluating batch (dim = [B, F]
+    :param feature_bank: FeatureBank or IVFIndex of the support set
+    :param classes: number of classes
+    :param configs: list of (knn_k, knn_t, weighting), see knn_predict and knn_vote
+    :param rm_top1: see knn_predict
+    :param tile_size: see knn_predict
+    :param self_indices: see knn_predict
+    :return: list with the prediction scores of each config (dim = [B, classes]
+    """
+    nearest_distances, nearest_neighbors = feature_bank.search(feature, max(knn_k for knn_k, _, _ in configs),
+                                                               tile_size=tile_size, self_indices=self_indices)
     if rm_top1:
-        mask = torch.ones(nearest_neighbors.shape[1], dtype=torch.bool)
-        mask[0] = False  # mask the first element
-        nearest_neighbors_dropped = nearest_neighbors[:, mask]
-        nearest_labels = feature_labels[nearest_neighbors_dropped]
-    else:
-        nearest_labels = feature_labels[nearest_neighbors]
+        nearest_distances, nearest_neighbors = nearest_distances[:, 1:], nearest_neighbors[:, 1:]
+    nearest_labels = feature_bank.labels[nearest_neighbors]
+    n_removed = 1 if rm_top1 else 0
+    return [knn_vote(nearest_distances[:, :knn_k - n_removed], nearest_labels[:, :knn_k - n_removed], classes, knn_t,
+                     weighting) for knn_k, knn_t, weighting in configs]
 
-    # Compute the weighted scores using the inverse distances
-    inv_distances = (1.0 / distances[:, :knn_k])
-    knn_scores = torch.zeros(B, classes, device=feature.device)
 
-    for i in range(B):
-        for j in range(knn_k - 1 if rm_top1 else knn_k):
-            knn_scores[i, nearest_labels[i, j]] += inv_distances[i, j]
+def knn_predict_self(feature_bank, classes, knn_k, knn_t, tile_size=None):
+    """
+    knn prediction of every pt of the feature bank, using the feature bank itself as the queries. Each pt is excluded
+    from its own neighbors by index, so a duplicate of the pt stays one of its neighbors (with the clamped distance of
+    knn_vote) instead of being dropped in its place.
+    :param feature_bank: FeatureBank of the support set
+    :param classes: number of classes
+    :param knn_k: number of nearest neighbors, not counting the pt itself
+    :param knn_t: temperature
+    :param tile_size: number of feature bank pts per tile, see knn_topk_self
+    :return: prediction scores for each class (dim = [K, classes]
+    """
+    nearest_distances, nearest_neighbors = knn_topk_self(feature_bank, knn_k, tile_size=tile_size)
+    return knn_vote(nearest_distances, feature_bank.labels[nearest_neighbors], classes, knn_t)
 
-    # Apply temperature scaling
-    knn_scores /= knn_t
 
-    return knn_scores
+def knn_predict_self_sweep(feature_bank, classes, configs, tile_size=None):
+    """
+    knn_predict_self of several knn configurations from a single neighbor search, see knn_predict_sweep
+    :param configs: list of (knn_k, knn_t, weighting), knn_k not counting the pt itself
+    :return: list with the prediction scores of each config (dim = [K, classes]
+    """
+    nearest_distances, nearest_neighbors = knn_topk_self(feature_bank, max(knn_k for knn_k, _, _ in configs),
+                                                         tile_size=tile_size)
+    nearest_labels = feature_bank.labels[nearest_neighbors]
+    return [knn_vote(nearest_distances[:, :knn_k], nearest_labels[:, :knn_k], classes, knn_t, weighting)
+            for knn_k, knn_t, weighting in configs]
 
 
 class BasicBlockPD(nn.Module):
@@ -156,6 +556,7 @@ class BasicBlockPD(nn.Module):
         self.bn1 = nn.BatchNorm2d(planes)
         self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn2 = nn.BatchNorm2d(planes)
+        self.preact = nn.Identity()
 
         self.shortcut = nn.Sequential()
         if stride != 1 or in_planes != self.expansion*planes:
@@ -164,15 +565,12 @@ class BasicBlockPD(nn.Module):
                 nn.BatchNorm2d(self.expansion*planes)
             )
 
-    def forward(self, x, train=True):
+    def forward(self, x):
         out = F.relu_(self.bn1(self.conv1(x)))
         out = self.bn2(self.conv2(out))
         out += self.shortcut(x)
-        if not train:
-            return None, out
-        else:
-            out = F.relu(out)
-            return out
+        out = self.preact(out)  # tap point of the block, before relu
+        return F.relu(out)
 
 
 class ResNetPD(nn.Module):
@@ -205,53 +603,32 @@ class ResNetPD(nn.Module):
         :param train: switch model to test and extract the FMs of the kth layer
         :return:
         '''
-        i = 0
-        out = self.bn1(self.conv1(x))
-        if k==i and not(train):
-            return None, out.view(out.shape[0], -1)
-        out = torch.relu_(out)
-        i +=1
-        for module in self.layer1:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
-
-        for module in self.layer2:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
-        for module in self.layer3:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
-        for module in self.layer4:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
+        if not train:
+            return None, self.forward_taps(x, taps=[k])[0]
+        out = torch.relu(self.bn1(self.conv1(x)))
+        out = self.layer4(self.layer3(self.layer2(self.layer1(out))))
         out = F.avg_pool2d(out, 4)
-        out = out.view(out.size(0), -1)
-        out = self.fc(out) / self.temp
-        if k == i and not (train):
-            _f = F.softmax(out, 1)  # take the output of softmax
-            return None, _f
-        else:
-            return out
+        out = out.reshape(out.size(0), -1)
+        return self.fc(out) / self.temp
+
+    def tap_layers(self):
+        '''
+        the first conv (after bn1), every ResBlock before its relu and the softmax of the last layer
+        '''
+        blocks = ['{}.{}.preact'.format(layer, i) for layer in ('layer1', 'layer2', 'layer3', 'layer4')
+                  for i in range(len(getattr(self, layer)))]
+        return ([('bn1', None)] + [(name, None) for name in blocks] +
+                [('fc', lambda logits: F.softmax(logits / self.temp, 1))])
+
+    def forward_taps(self, x, taps=None):
+        '''
+        output the FMs of every probed layer in a single forward pass, stopped after the deepest tap
+        :param x:
+        :param taps: indices of the taps to return (None: all of them)
+        :return: list of B x (C x F x F) FMs, index k matches the k of forward()
+        '''
+        return TapRegistry(self, self.tap_layers())(x, taps)
+
 
 class Conv2d(nn.Conv2d):
 
@@ -260,14 +637,16 @@ class Conv2d(nn.Conv2d):
         super(Conv2d, self).__init__(in_channels, out_channels, kernel_size, stride,
                  padding, dilation, groups, bias)
 
-    def forward(self, x):
+    def standardized_weight(self):
         weight = self.weight
         weight_mean = weight.mean(dim=1, keepdim=True).mean(dim=2,
                                   keepdim=True).mean(dim=3, keepdim=True)
         weight = weight - weight_mean
-        std = weight.view(weight.size(0), -1).std(dim=1).view(-1, 1, 1, 1) + 1e-5
-        weight = weight / std.expand_as(weight)
-        return F.conv2d(x, weight, self.bias, self.stride,
+        std = weight.reshape(weight.size(0), -1).std(dim=1).view(-1, 1, 1, 1) + 1e-5
+        return weight / std.expand_as(weight)
+
+    def forward(self, x):
+        return F.conv2d(x, self.standardized_weight(), self.bias, self.stride,
                         self.padding, self.dilation, self.groups)
 
 
@@ -280,6 +659,7 @@ class BasicBlockWS(nn.Module):
         self.gn1 = nn.GroupNorm(1, planes)
         self.conv2 = Conv2d(planes, planes, kernel_size=3, stride=1, padding=1, bias=False)
         self.gn2 = nn.GroupNorm(1, planes)
+        self.preact = nn.Identity()
 
         self.shortcut = nn.Sequential()
         if stride != 1 or in_planes != self.expansion*planes:
@@ -288,15 +668,12 @@ class BasicBlockWS(nn.Module):
                 nn.GroupNorm(1, self.expansion*planes)
             )
 
-    def forward(self, x, train=True):
+    def forward(self, x):
         out = F.relu_(self.gn1(self.conv1(x)))
         out = self.gn2(self.conv2(out))
         out += self.shortcut(x)
-        if not train:
-            return None, out
-        else:
-            out = F.relu(out)
-            return out
+        out = self.preact(out)  # tap point of the block, before relu
+        return F.relu(out)
 
 
 class ResNetWS(nn.Module):
@@ -332,50 +709,320 @@ class ResNetWS(nn.Module):
         :param train: switch model to test and extract the FMs of the kth layer
         :return:
         '''
-        i = 0
-        out = self.gn1(self.conv1(x))
-        if k==i and not(train):
-            return None, out.view(out.shape[0], -1)
-        out = torch.relu_(out)
-        i +=1
-        for module in self.layer1:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
-
-        for module in self.layer2:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
-        for module in self.layer3:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
-        for module in self.layer4:
-            if k ==i and not(train):
-                _, out = module(out, train=False)    # take the output of ResBlock before relu
-                return None, out.view(out.shape[0], -1)
-            else:
-                out = module(out)
-            out = torch.relu_(out)
-            i+=1
+        if not train:
+            return None, self.forward_taps(x, taps=[k])[0]
+        out = torch.relu(self.gn1(self.conv1(x)))
+        out = self.layer4(self.layer3(self.layer2(self.layer1(out))))
         out = F.avg_pool2d(out, 4)
-        out = out.view(out.size(0), -1)
-        out = self.fc(out) / self.temp
-        if k == i and not (train):
-            _f = F.softmax(out, 1)  # take the output of softmax
-            return None, _f
+        out = out.reshape(out.size(0), -1)
+        return self.fc(out) / self.temp
+
+    def tap_layers(self):
+        '''
+        the first conv (after gn1), every ResBlock before its relu and the softmax of the last layer
+        '''
+        blocks = ['{}.{}.preact'.format(layer, i) for layer in ('layer1', 'layer2', 'layer3', 'layer4')
+                  for i in range(len(getattr(self, layer)))]
+        return ([('gn1', None)] + [(name, None) for name in blocks] +
+                [('fc', lambda logits: F.softmax(logits / self.temp, 1))])
+
+    def forward_taps(self, x, taps=None):
+        '''
+        output the FMs of every probed layer in a single forward pass, stopped after the deepest tap
+        :param x:
+        :param taps: indices of the taps to return (None: all of them)
+        :return: list of B x (C x F x F) FMs, index k matches the k of forward()
+        '''
+        return TapRegistry(self, self.tap_layers())(x, taps)
+
+
+def prediction_depths(knn_labels_all):
+    """
+    get prediction depth for every sample. walk the knn labels from the last layer downward and count the layers until
+    the label is different, all samples at once
+    :param knn_labels_all: knn labels of every layer (N x L)
+    :return: prediction depths (N)
+    """
+    max_depth = knn_labels_all.shape[1]
+    agree = (knn_labels_all == knn_labels_all[:, -1:]).flip(1)
+    pd = agree.long().cumprod(dim=1).sum(dim=1)  # number of layers agreeing with the last one before the first change
+    return max_depth - pd.clamp(max=max_depth - 1)
+
+
+class SpatialPool(nn.Module):
+    """
+    tap reducer: average / max pooling of a B x C x H x W fm to a fixed grid, other taps are left as they are
+    """
+    def __init__(self, grid, mode='avg'):
+        super(SpatialPool, self).__init__()
+        if mode not in ('avg', 'max'):
+            raise ValueError('unknown pooling {}'.format(mode))
+        self.grid = grid
+        self.mode = mode
+
+    def forward(self, fm):
+        if fm.dim() != 4 or fm.shape[2] * fm.shape[3] <= self.grid * self.grid:
+            return fm
+        pool = F.adaptive_avg_pool2d if self.mode == 'avg' else F.adaptive_max_pool2d
+        return pool(fm, self.grid)
+
+
+class RandomProjection(nn.Module):
+    """
+    tap reducer: seeded random projection of the flattened tap to out_features dims, gaussian or sparse ({-1, 0, 1}
+    with probabilities 1/6, 2/3, 1/6), scaled to preserve distances in expectation. The projection matrix is drawn at
+    the first call, taps with at most out_features dims are left as they are.
+    """
+    def __init__(self, out_features, sparse=False, seed=0):
+        super(RandomProjection, self).__init__()
+        self.out_features = out_features
+        self.sparse = sparse
+        self.seed = seed
+        self.register_buffer('matrix', None)
+
+    def forward(self, fm):
+        fm = fm.flatten(1)
+        if fm.shape[1] <= self.out_features:
+            return fm
+        if self.matrix is None:
+            generator = torch.Generator().manual_seed(self.seed)
+            shape = (fm.shape[1], self.out_features)
+            if self.sparse:
+                matrix = torch.randint(0, 6, shape, generator=generator)
+                matrix = ((matrix == 0).float() - (matrix == 1).float()) * (3.0 / self.out_features) ** 0.5
+            else:
+                matrix = torch.randn(shape, generator=generator) / self.out_features ** 0.5
+            self.matrix = matrix.to(fm.device)
+        return fm @ self.matrix.to(fm.dtype)
+
+
+class PCAProjection(nn.Module):
+    """
+    tap reducer: projection of the flattened tap on its out_features principal components, see fit. Until it is fit
+    (and for taps with at most out_features dims) the tap is left as it is.
+    """
+    def __init__(self, out_features):
+        super(PCAProjection, self).__init__()
+        self.out_features = out_features
+        self.register_buffer('mean', None)
+        self.register_buffer('components', None)
+
+    def fit(self, features):
+        """
+        :param features: flattened taps of a sample of the support set (dim = [N, F]
+        """
+        x = features.float()
+        if x.shape[1] <= self.out_features:
+            return
+        self.mean = x.mean(0)
+        x = x - self.mean
+        k = min(self.out_features, x.shape[0])
+        if x.shape[0] < x.shape[1]:
+            # eigenvectors of the N x N gram matrix, much smaller than the F x F covariance for early layers
+            eigenvalues, eigenvectors = torch.linalg.eigh((x @ x.t()).double())
+            eigenvalues, eigenvectors = eigenvalues[-k:].flip(0), eigenvectors[:, -k:].flip(1)
+            # the centered gram matrix has rank < N, directions without variance are dropped instead of blown up
+            scale = torch.where(eigenvalues > eigenvalues[0] * 1e-9, eigenvalues.clamp_min(1e-30).rsqrt(),
+                                torch.zeros_like(eigenvalues))
+            self.components = (x.t() @ (eigenvectors * scale[None, :]).float()).contiguous()
         else:
-            return out
+            self.components = torch.linalg.eigh((x.t() @ x).double())[1][:, -k:].flip(1).float().contiguous()
+
+    def forward(self, fm):
+        fm = fm.flatten(1)
+        if self.components is None or fm.shape[1] != self.components.shape[0]:
+            return fm
+        return (fm - self.mean.to(fm.dtype)) @ self.components.to(fm.dtype)
+
+
+def make_tap_reducers(spec, n_taps, seed=0):
+    """
+    tap reducers of every tap from a spec applied to each tap in turn, e.g. 'avgpool:4', 'rp:1024', 'maxpool:2,pca:256'
+    avgpool:G / maxpool:G pool the fm to a G x G grid, rp:D / sparse_rp:D project to D dims (seeded by seed and the tap
+    index), pca:D projects on the D principal components (last stage only, see fit_tap_reducers)
+    :param spec: comma separated stages, '' for no reduction
+    :param n_taps: number of taps of the model
+    :return: nn.ModuleList with one nn.Sequential per tap, None for an empty spec
+    """
+    if not spec:
+        return None
+    stages = [stage.split(':') for stage in spec.split(',')]
+    if any(name == 'pca' for name, _ in stages[:-1]):
+        raise ValueError('pca has to be the last stage of {}'.format(spec))
+    reducers = nn.ModuleList()
+    for k in range(n_taps):
+        reducer = nn.Sequential()
+        for name, value in stages:
+            if name in ('avgpool', 'maxpool'):
+                reducer.append(SpatialPool(int(value), mode=name[:3]))
+            elif name in ('rp', 'sparse_rp'):
+                reducer.append(RandomProjection(int(value), sparse=name == 'sparse_rp', seed=seed * 1000 + k))
+            elif name == 'pca':
+                reducer.append(PCAProjection(int(value)))
+            else:
+                raise ValueError('unknown tap reduction {}'.format(name))
+        reducers.append(reducer)
+    return reducers
+
+
+def fit_tap_reducers(model, taps):
+    """
+    fit the PCA stages of the tap reducers of the model
+    :param taps: flattened taps of a sample of the support set, computed by model.forward_taps before the fit
+                (list with one N x F tensor per tap)
+    """
+    for reducer, tap in zip(model.tap_reducers, taps):
+        for stage in reducer:
+            if isinstance(stage, PCAProjection):
+                stage.fit(tap)
+
+
+def reduce_tap(model, k, fm):
+    """
+    the k-th tap of forward_taps: the fm reduced by model.tap_reducers[k] if the model has tap reducers (see
+    make_tap_reducers), flattened to B x F
+    """
+    reducers = getattr(model, 'tap_reducers', None)
+    if reducers is not None:
+        fm = reducers[k](fm)
+    return fm.flatten(1)
+
+
+def _fuse_conv_bn(module, prefix='', tapped=()):
+    """
+    fold every BatchNorm2d directly following a conv inside module (not recursively) into the conv
+    :param prefix: name of module in the model, e.g. 'layer1.0'
+    :param tapped: names of the tapped modules, a tapped conv keeps its output (its BN is not folded into it)
+    """
+    def is_tapped(name):
+        return (prefix + '.' + name if prefix else name) in tapped
+
+    for conv_name, bn_name in (('conv1', 'bn1'), ('conv2', 'bn2')):
+        conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and not is_tapped(conv_name):
+            setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d) and not is_tapped(str(i)):
+                module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                module[i + 1] = nn.Identity()
+
+
+def export_for_inference(model):
+    """
+    frozen copy of a model for feature extraction with the same tap outputs: BatchNorm2d is folded into the preceding
+    conv (unless the conv itself is tapped, e.g. by default_tap_layers) and the weight standardization of Conv2d is
+    computed once instead of at every forward call
+    :param model: model in eval mode (BN uses its running statistics)
+    :return: the exported model in eval mode
+    """
+    model = copy.deepcopy(model).eval()
+    tapped = set(TapRegistry(model).names)
+    with torch.no_grad():
+        for prefix, module in list(model.named_modules()):
+            for name, child in module.named_children():
+                if isinstance(child, Conv2d):
+                    conv = nn.Conv2d(child.in_channels, child.out_channels, child.kernel_size, child.stride,
+                                     child.padding, child.dilation, child.groups, child.bias is not None)
+                    conv.weight.copy_(child.standardized_weight())
+                    if child.bias is not None:
+                        conv.bias.copy_(child.bias)
+                    setattr(module, name, conv.to(child.weight.device))
+            _fuse_conv_bn(module, prefix, tapped)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+class _TapForward(nn.Module):
+    """
+    module whose forward pass returns the taps of model (see TapRegistry), so that they can be vmapped
+    """
+    def __init__(self, model):
+        super(_TapForward, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return tuple(TapRegistry(self.model)(x))
+
+
+class ModelEnsemble(object):
+    """
+    N models of the same architecture (e.g. one per seed) run as a single vmapped model (torch.func): their parameters
+    and buffers are stacked along a new first dim and every member sees its own batch, so that small models fill the
+    cores and share the kernel launches. BN running statistics of every member are updated in its stacked buffers,
+    dropout draws different masks per member. Optimizers of the stacked parameters (e.g. SGD) update every member as
+    its own optimizer would.
+    """
+    def __init__(self, models):
+        """
+        :param models: the member models, same architecture and state dict keys (e.g. with the same tap reducers)
+        """
+        self.models = models
+        self.params, self.buffers = stack_module_state(models)
+        self.base = copy.deepcopy(models[0]).to('meta')  # only the structure is used, the state is passed in
+
+    def __len__(self):
+        return len(self.models)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self, mode=True):
+        self.base.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def _vmap(self, module, state, x, shared):
+        return vmap(lambda params, buffers, x: functional_call(module, (params, buffers), (x,)),
+                    in_dims=(0, 0, None if shared else 0), randomness='different')(*state, x)
+
+    def __call__(self, x, shared=False):
+        """
+        :param x: one batch per member (N x B x ...), or one batch for all members if shared (B x ...)
+        :return: the outputs of the members (N x B x ...)
+        """
+        return self._vmap(self.base, (self.params, self.buffers), x, shared)
+
+    def forward_taps(self, x, shared=False):
+        """
+        :param x: see __call__
+        :return: list with the N x B x F fms of every tap of the members (see TapRegistry)
+        """
+        prefixed = tuple({'model.' + name: tensor for name, tensor in state.items()}
+                         for state in (self.params, self.buffers))
+        return list(self._vmap(_TapForward(self.base), prefixed, x, shared))
+
+    def unstack(self):
+        """
+        :return: the member models with the current state of their stacked parameters and buffers
+        """
+        with torch.no_grad():
+            for i, model in enumerate(self.models):
+                model.load_state_dict({name: tensor[i] for state in (self.params, self.buffers)
+                                       for name, tensor in state.items()}, strict=False)
+        return self.models
+
+
+def get_model(arch, num_classes=10):
+    """
+    model for computing Prediction Depth
+    :param arch: vgg / mlp / resnet / resnet_ws (ResNet18 with weight standardization and group norm) / tv_<name>
+                (torchvision model <name>, probed with default_tap_layers)
+    :param num_classes: number of classes
+    :return: the model
+    """
+    if arch == 'mlp':
+        return MLP7(num_classes)
+    elif arch == 'vgg':
+        return VGGPD(vgg16().features, num_classes)
+    elif arch == 'resnet':
+        return ResNetPD(BasicBlockPD, [2, 2, 2, 2], num_classes=num_classes, temp=1.0)
+    elif arch == 'resnet_ws':
+        return ResNetWS(BasicBlockWS, [2, 2, 2, 2], num_classes=num_classes, temp=1.0)
+    elif arch.startswith('tv_'):
+        return torchvision.models.get_model(arch[3:], num_classes=num_classes)
+    raise NotImplementedError
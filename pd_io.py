@@ -0,0 +1,146 @@
+import os
+import glob
+import json
+import re
+import numpy as np
+
+
+def save_pd_result(path, indices, knn_labels, knn_conf_gt, pds, sweep=None):
+    """
+    save the prediction depth result of a split as typed numpy arrays in an uncompressed .npz file
+    :param path: path of the result file, should end with .npz
+    :param indices: dataset index of each sample (N)
+    :param knn_labels: knn label of each sample at each layer (N x L)
+    :param knn_conf_gt: knn confidence of the ground truth label of each sample at each layer (N x L)
+    :param pds: prediction depth of each sample (N)
+    :param sweep: results of several knn configs, dict with 'knn_k', 'knn_t' and 'weighting' (C), 'pd' (C x N),
+                'knn_labels' and 'knn_conf_gt' (C x N x L), saved with the prefix 'sweep_' (see load_pd_sweep)
+    """
+    arrays = {}
+    if sweep is not None:
+        dtypes = {'knn_k': np.int64, 'knn_t': np.float32, 'weighting': str, 'pd': np.int16, 'knn_labels': np.int16,
+                  'knn_conf_gt': np.float32}
+        arrays = {'sweep_' + key: np.asarray(sweep[key], dtype=dtype) for key, dtype in dtypes.items()}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, indices=np.asarray(indices, dtype=np.int64), knn_labels=np.asarray(knn_labels, dtype=np.int16),
+                 knn_conf_gt=np.asarray(knn_conf_gt, dtype=np.float32), pd=np.asarray(pds, dtype=np.int16), **arrays)
+    os.replace(tmp_path, path)  # a crashed run never leaves a truncated result behind
+
+
+def load_pd_result(path):
+    """
+    load a prediction depth result saved by save_pd_result, or a legacy json result ({index: [pd]} in a .pkl file)
+    :param path: path of the result file, the extension can be left out if the .npz or the .pkl file exists
+    :return: dict of numpy arrays with keys 'indices' and 'pd', and also 'knn_labels' and 'knn_conf_gt' for .npz files
+    """
+    if not os.path.exists(path):
+        for ext in ('.npz', '.pkl'):
+            if os.path.exists(path + ext):
+                path += ext
+                break
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return {key: f[key] for key in f.files}
+    with open(path, 'r') as f:
+        pd_dict = json.load(f)
+    return {'indices': np.fromiter(map(int, pd_dict.keys()), dtype=np.int64, count=len(pd_dict)),
+            'pd': np.array([v[0] for v in pd_dict.values()], dtype=np.int16)}
+
+
+def load_pd_sweep(path):
+    """
+    load the results of every knn config of a result file saved with a sweep
+    :param path: path of the result file, see load_pd_result
+    :return: list with a dict per knn config: 'knn_k', 'knn_t', 'weighting', and the 'pd' (N), 'knn_labels' and
+            'knn_conf_gt' (N x L) of the samples 'indices' (N)
+    """
+    result = load_pd_result(path)
+    if 'sweep_pd' not in result:
+        raise ValueError('{} has no knn sweep'.format(path))
+    return [{'knn_k': int(result['sweep_knn_k'][c]), 'knn_t': float(result['sweep_knn_t'][c]),
+             'weighting': str(result['sweep_weighting'][c]), 'indices': result['indices'], 'pd': result['sweep_pd'][c],
+             'knn_labels': result['sweep_knn_labels'][c], 'knn_conf_gt': result['sweep_knn_conf_gt'][c]}
+            for c in range(len(result['sweep_pd']))]
+
+
+def fill_pd(pd_row, path):
+    """
+    write the prediction depths of a result file into a row indexed by dataset index
+    :param pd_row: array with one entry per sample of the dataset
+    :param path: path of the result file, see load_pd_result
+    :return: pd_row
+    """
+    result = load_pd_result(path)
+    pd_row[result['indices']] = result['pd']
+    return pd_row
+
+
+def _average_ranks(x):
+    """
+    ranks starting at 1, tied values get the average of their ranks
+    """
+    _, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    return (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+
+
+def compare_pds(pd_a, pd_b):
+    """
+    agreement of two prediction depths of the same samples
+    :param pd_a: prediction depths (N)
+    :param pd_b: prediction depths of the same samples in the same order (N)
+    :return: dict with the number of samples, the fraction of equal pds, the fraction of pds within 1 of each other,
+            the mean absolute difference and the spearman rank correlation
+    """
+    pd_a, pd_b = np.asarray(pd_a, dtype=np.float64), np.asarray(pd_b, dtype=np.float64)
+    diff = np.abs(pd_a - pd_b)
+    rank_a, rank_b = _average_ranks(pd_a), _average_ranks(pd_b)
+    if len(pd_a) > 1 and rank_a.std() > 0 and rank_b.std() > 0:
+        spearman = float(np.corrcoef(rank_a, rank_b)[0, 1])
+    else:
+        spearman = float('nan')
+    return {'n_samples': int(len(pd_a)), 'equal': float(np.mean(diff == 0)), 'within_1': float(np.mean(diff <= 1)),
+            'mean_abs_diff': float(diff.mean()), 'spearman': spearman}
+
+
+def pd_agreement(path_a, path_b):
+    """
+    compare the prediction depths of two result files of the same split, e.g. an approximate run against the exact one
+    :param path_a: path of the first result file, see load_pd_result
+    :param path_b: path of the second result file
+    :return: see compare_pds, on the samples present in both files
+    """
+    result_a, result_b = load_pd_result(path_a), load_pd_result(path_b)
+    _, idx_a, idx_b = np.intersect1d(result_a['indices'], result_b['indices'], return_indices=True)
+    return compare_pds(result_a['pd'][idx_a], result_b['pd'][idx_b])
+
+
+def pd_trajectory_prefix(result_path):
+    """
+    :param result_path: path of the final result of a run without extension
+    :return: prefix of the per-epoch results of the run, '<prefix>_epoch<E>.npz'. They are kept in the pd_probe
+            subdirectory of the result directory, apart from the final results that are averaged over a directory
+    """
+    directory, name = os.path.split(result_path)
+    return os.path.join(directory, 'pd_probe', name + '_probe')
+
+
+def load_pd_trajectory(prefix):
+    """
+    load the per-epoch prediction depths of the probe samples of a run, as saved during training
+    :param prefix: see pd_trajectory_prefix
+    :return: dict of numpy arrays: 'epochs' (E, ascending), 'indices' (N), 'pd' (E x N), 'knn_labels' and
+            'knn_conf_gt' (E x N x L)
+    """
+    results = {}
+    for path in glob.glob(glob.escape(prefix) + '_epoch*.npz'):
+        match = re.fullmatch(re.escape(prefix) + r'_epoch(\d+)\.npz', path)
+        if match is not None:
+            results[int(match.group(1))] = load_pd_result(path)
+    epochs = sorted(results)
+    if not epochs:
+        raise FileNotFoundError('no per-epoch results with prefix {}'.format(prefix))
+    trajectory = {'epochs': np.array(epochs, dtype=np.int64), 'indices': results[epochs[0]]['indices']}
+    for key in ('pd', 'knn_labels', 'knn_conf_gt'):
+        trajectory[key] = np.stack([results[epoch][key] for epoch in epochs])
+    return trajectory
@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+
+
+class Prefetcher(object):
+    """
+    Runs an iterable in a background thread, at most depth items ahead of the consumer (bounded queue), so that
+    producing the next item overlaps consuming the current one. torch releases the GIL inside its ops, so a forward
+    pass in the producer and a knn search in the consumer run in parallel on different cores.
+    Exceptions of the producer are raised in the consumer. Grad mode and autocast are thread local, a producer that
+    needs them has to enter them itself (e.g. inside a generator).
+    """
+    _done = object()
+
+    def __init__(self, iterable, depth=2, name='producer'):
+        """
+        :param iterable: iterable of the producer stage, iterated in the background thread
+        :param depth: maximum number of items produced ahead of the consumer
+        :param name: name of the producer stage in the report
+        """
+        self.iterable = iterable
+        self.depth = depth
+        self.name = name
+        self.produce_seconds = 0.0  # time the producer spent computing items
+        self.wait_seconds = 0.0  # time the consumer spent waiting for an item
+        self.wall_seconds = 0.0
+        self.n_items = 0
+        self._iterator = None
+
+    def _produce(self, items, stop):
+        try:
+            iterator = iter(self.iterable)
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.produce_seconds += time.perf_counter() - start
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except BaseException as e:
+            items.put((None, e))
+            return
+        items.put((self._done, None))
+
+    def __iter__(self):
+        self._iterator = self._iterate()
+        return self._iterator
+
+    def close(self):
+        """
+        stop the producer of a consumer that stopped early, and account the wall time up to now
+        """
+        if self._iterator is not None:
+            self._iterator.close()
+
+    def _iterate(self):
+        items = queue.Queue(maxsize=max(self.depth, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(items, stop), name=self.name, daemon=True)
+        start = time.perf_counter()
+        thread.start()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                item, error = items.get()
+                self.wait_seconds += time.perf_counter() - wait_start
+                if error is not None:
+                    raise error
+                if item is self._done:
+                    break
+                self.n_items += 1
+                yield item
+        finally:
+            stop.set()  # the consumer may stop early, the producer then stops at its next item
+            while thread.is_alive():
+                try:
+                    items.get_nowait()
+                except queue.Empty:
+                    thread.join(0.1)
+            self.wall_seconds += time.perf_counter() - start
+
+    def utilization(self):
+        """
+        :return: dict with the fraction of the wall time each stage was busy, a stage below 1 waits for the other
+        """
+        wall = max(self.wall_seconds, 1e-12)
+        return {self.name: min(self.produce_seconds / wall, 1.0),
+                'consumer': min(max(wall - self.wait_seconds, 0.0) / wall, 1.0),
+                'items': self.n_items, 'wall_seconds': self.wall_seconds}
+
+    def report(self, consumer_name='consumer'):
+        """
+        :return: one line summary of utilization()
+        """
+        stats = self.utilization()
+        return '{}: busy {:.0%}, {}: busy {:.0%} ({} items in {:.1f} s)'.format(
+            self.name, stats[self.name], consumer_name, stats['consumer'], stats['items'], stats['wall_seconds'])
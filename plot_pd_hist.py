@@ -1,9 +1,9 @@
 import os
 import numpy as np
-import json
 import matplotlib.pyplot as plt
 import argparse
 import os
+from pd_io import fill_pd
 
 parser = argparse.ArgumentParser(description='arguments to compute prediction depth for each data sample')
 parser.add_argument('--result_dir', default='./cl_results_wsgn', type=str, help='directory to save ckpt and results')
@@ -21,17 +21,9 @@ pd_dir = args.result_dir
 print('computing prediction depth in train split')
 pd_train_split = np.zeros((len(seeds), args.num_samples))
 for i, sd in enumerate(seeds):
-
-            f = os.path.join(pd_dir, '{}train_seed{}_f_trainpd.pkl'.format(arch, sd))
-            with open(f, 'r') as p:
-                pd_dict = json.load(p)
-            for k, v in pd_dict.items():
-                pd_train_split[i, int(k)] = v[0]
-            f = os.path.join(pd_dir, '{}train_seed{}_fflip_trainpd.pkl'.format(arch, sd))
-            with open(f, 'r') as p:
-                pd_dict = json.load(p)
-            for k, v in pd_dict.items():
-                pd_train_split[i, int(k)] = v[0]
+            # .npz results of get_pd_vgg.py are preferred, legacy json .pkl results are read as a fallback
+            fill_pd(pd_train_split[i], os.path.join(pd_dir, '{}train_seed{}_f_trainpd'.format(arch, sd)))
+            fill_pd(pd_train_split[i], os.path.join(pd_dir, '{}train_seed{}_fflip_trainpd'.format(arch, sd)))
 
 print(pd_train_split.shape)
 pd_train_split_avg = pd_train_split.mean(0)
@@ -40,17 +32,8 @@ train_split_small_pds = np.where((pd_train_split_avg >1) & (pd_train_split_avg <
 print('computing prediction depth in test split')
 pd_test_split = np.zeros((len(seeds), args.num_samples))
 for i, sd in enumerate(seeds):
-            f = os.path.join(pd_dir, '{}_seed{}_f_test_pd.pkl'.format(arch, sd))
-            with open(f, 'r') as p:
-                pd_dict = json.load(p)
-            for k, v in pd_dict.items():
-                pd_test_split[i, int(k)] = v[0]
-
-            f = os.path.join(pd_dir, '{}_seed{}_fflip_test_pd.pkl'.format(arch, sd))
-            with open(f, 'r') as p:
-                pd_dict = json.load(p)
-            for k, v in pd_dict.items():
-                pd_test_split[i, int(k)] = v[0]
+            fill_pd(pd_test_split[i], os.path.join(pd_dir, '{}_seed{}_f_test_pd'.format(arch, sd)))
+            fill_pd(pd_test_split[i], os.path.join(pd_dir, '{}_seed{}_fflip_test_pd'.format(arch, sd)))
 
 def show_sample(index, dataset):
     img, _ = dataset[index]
@@ -0,0 +1,37 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from knndnn import get_model, export_for_inference, TapRegistry
+
+
+def _randomize_bn(model, generator):
+    """
+    BN statistics and affine parameters as after training, at initialization BN is close to the identity and folding
+    it into the wrong tap would go unnoticed
+    """
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                n = module.num_features
+                module.running_mean.copy_(torch.randn(n, generator=generator))
+                module.running_var.copy_(torch.rand(n, generator=generator) + 0.5)
+                module.weight.copy_(torch.rand(n, generator=generator) + 0.5)
+                module.bias.copy_(torch.randn(n, generator=generator))
+
+
+@pytest.mark.parametrize('arch', ['resnet', 'resnet_ws', 'tv_resnet18', 'tv_vgg11_bn', 'tv_mobilenet_v2'])
+def test_export_keeps_taps(arch):
+    generator = torch.Generator().manual_seed(0)
+    torch.manual_seed(0)
+    model = get_model(arch)
+    _randomize_bn(model, generator)
+    model.eval()
+    x = torch.randn(2, 3, 32, 32, generator=generator)
+    with torch.no_grad():
+        expected = TapRegistry(model)(x)
+        taps = TapRegistry(export_for_inference(model))(x)
+    assert len(taps) == len(expected)
+    for k, (tap, reference) in enumerate(zip(taps, expected)):
+        scale = reference.abs().max().clamp_min(1e-6)
+        assert (tap - reference).abs().max() / scale < 1e-3, 'tap {} differs after export'.format(k)
@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+from knndnn import FeatureBank, knn_predict, knn_predict_self
+
+
+def knn_predict_reference(feature, feature_bank, feature_labels, classes, knn_k, knn_t, rm_top1=True,
+                          legacy_weights=False):
+    """
+    the double loop knn_predict of earlier versions, kept as the reference of the vectorized one
+    :param feature_bank: feature bank of the support set (dim = [F, K]
+    :param legacy_weights: weight the votes with the distances to the first knn_k pts of the feature bank (as earlier
+                    versions did) instead of the distances of the selected neighbors
+    """
+    B = feature.shape[0]
+    distances = torch.cdist(feature, feature_bank.t(), p=2)
+    nearest_neighbors = distances.argsort(dim=1)[:, :knn_k]
+    if legacy_weights:
+        weights = 1.0 / distances[:, :knn_k]
+    else:
+        weights = 1.0 / distances.gather(1, nearest_neighbors)
+    if rm_top1:
+        nearest_neighbors = nearest_neighbors[:, 1:]
+        if not legacy_weights:
+            weights = weights[:, 1:]
+    nearest_labels = feature_labels[nearest_neighbors]
+    knn_scores = torch.zeros(B, classes)
+    for i in range(B):
+        for j in range(knn_k - 1 if rm_top1 else knn_k):
+            knn_scores[i, nearest_labels[i, j]] += weights[i, j]
+    knn_scores /= knn_t
+    return knn_scores
+
+
+@pytest.mark.parametrize('rm_top1', [True, False])
+@pytest.mark.parametrize('legacy_weights', [True, False])
+@pytest.mark.parametrize('tile_size', [None, 7])
+def test_knn_predict_matches_reference(rm_top1, legacy_weights, tile_size):
+    generator = torch.Generator().manual_seed(0)
+    classes, knn_k, knn_t = 10, 30, 0.5
+    feature_bank = torch.randn(64, 200, generator=generator)  # F x K
+    feature_labels = torch.randint(0, classes, (200,), generator=generator)
+    # the first queries are close to pts of the bank, as in the train split (not equal, a 0 distance has no finite
+    # weight)
+    feature = torch.cat([feature_bank[:, :8].t() + 0.1 * torch.randn(8, 64, generator=generator),
+                         torch.randn(24, 64, generator=generator)])
+    expected = knn_predict_reference(feature, feature_bank, feature_labels, classes, knn_k, knn_t, rm_top1=rm_top1,
+                                     legacy_weights=legacy_weights)
+    for bank in (feature_bank, FeatureBank(feature_bank.t(), feature_labels)):
+        scores = knn_predict(feature, bank, feature_labels, classes, knn_k, knn_t, rm_top1=rm_top1,
+                             legacy_weights=legacy_weights, tile_size=tile_size)
+        torch.testing.assert_close(scores, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_knn_predict_self_duplicates():
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(50, 16, generator=generator)
+    features[1] = features[0]
+    labels = torch.randint(0, 10, (50,), generator=generator)
+    scores = knn_predict_self(FeatureBank(features, labels), 10, 5, 1.0)
+    probs = torch.nn.functional.normalize(scores, p=1, dim=1)
+    assert torch.isfinite(probs).all()
+    # the duplicate is the nearest neighbor of the other, its vote dominates
+    assert probs[0].argmax() == labels[1] and probs[1].argmax() == labels[0]